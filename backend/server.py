@@ -1,21 +1,37 @@
-from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, status
+from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, Depends, Header, HTTPException, Query, Response, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
+import stat
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Set, Union
 import uuid
 import json
 from datetime import datetime, timedelta
 import jwt
 from passlib.context import CryptContext
 import asyncio
+try:
+    import orjson
+except ImportError:  # optional: faster encoder with native datetime support
+    orjson = None
+try:
+    import msgpack
+except ImportError:  # optional: enables the "msgpack" WebSocket subprotocol
+    msgpack = None
 import random
 import string
+import sys
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -29,8 +45,13 @@ db = client[os.environ['DB_NAME']]
 JWT_SECRET = "basemapp_secret_key_2025"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30 * 24 * 60  # 30 days
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(os.cpu_count() or 2)))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.environ.get('PASSWORD_HASH_QUEUE_LIMIT', '64'))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 security = HTTPBearer()
+# EventSource cannot set headers, so /events also accepts the token as a query parameter
+optional_security = HTTPBearer(auto_error=False)
 
 # Create the main app without a prefix
 app = FastAPI()
@@ -38,52 +59,966 @@ app = FastAPI()
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# In-process caches
+PRINCIPAL_CACHE_SIZE = int(os.environ.get('PRINCIPAL_CACHE_SIZE', '10000'))
+PRINCIPAL_CACHE_TTL = float(os.environ.get('PRINCIPAL_CACHE_TTL', '60'))
+
+class LRUCache:
+    """Bounded LRU cache with optional per-entry TTL and hit/miss/eviction counters"""
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (value, expires_at)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: str):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+# user_id -> UserResponse without avatar_url, used by get_current_user to skip the users lookup.
+# Avatars are base64 images of up to ~2.8 MB, so they are never cached here.
+principal_cache = LRUCache(PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL)
+
+CHAT_MEMBERSHIP_CACHE_SIZE = int(os.environ.get('CHAT_MEMBERSHIP_CACHE_SIZE', '50000'))
+
+# chat_id -> frozenset of participant ids; chats never change participants after creation
+membership_cache = LRUCache(CHAT_MEMBERSHIP_CACHE_SIZE)
+
+CLIENT_MSG_ID_CACHE_SIZE = int(os.environ.get('CLIENT_MSG_ID_CACHE_SIZE', '50000'))
+CLIENT_MSG_ID_CACHE_TTL = float(os.environ.get('CLIENT_MSG_ID_CACHE_TTL', '600'))
+
+# "sender_id:client_msg_id" -> (Message, persistence future or None); short-lived seen-set for retries
+recent_client_messages = LRUCache(CLIENT_MSG_ID_CACHE_SIZE, ttl=CLIENT_MSG_ID_CACHE_TTL)
+
+# Presence
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', '5'))  # seconds
+# Heartbeats from a connected user only re-persist last_seen once it is this stale
+PRESENCE_LAST_SEEN_RESOLUTION = float(os.environ.get('PRESENCE_LAST_SEEN_RESOLUTION', '60'))  # seconds
+
+class PresenceEntry:
+    __slots__ = ("is_online", "last_seen", "offline_timestamp", "dirty", "persisted_at")
+
+    def __init__(self, now: datetime):
+        self.is_online = False
+        self.last_seen = now
+        self.offline_timestamp: Optional[datetime] = None
+        self.dirty = False
+        self.persisted_at = now
+
+class PresenceService:
+    """Authoritative online/last_seen state for users connected to this worker.
+
+    Socket lifecycle, heartbeats and status calls only touch the in-memory
+    table; dirty entries are written back with one bulk_write every
+    PRESENCE_FLUSH_INTERVAL, so a user flapping online/offline within an
+    interval costs a single write. Read paths overlay the table on top of the
+    users document and fall back to Mongo for users not tracked here.
+    """
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self.entries: Dict[str, PresenceEntry] = {}
+        self.task: Optional[asyncio.Task] = None
+        self.transitions = 0
+        self.flushes = 0
+        self.flushed_writes = 0
+
+    def _entry(self, user_id: str, now: datetime) -> PresenceEntry:
+        entry = self.entries.get(user_id)
+        if entry is None:
+            entry = self.entries[user_id] = PresenceEntry(now)
+        return entry
+
+    def set_online(self, user_id: str):
+        now = datetime.utcnow()
+        entry = self._entry(user_id, now)
+        if not entry.is_online:
+            self.transitions += 1
+        entry.is_online = True
+        entry.last_seen = now
+        entry.dirty = True
+
+    def set_offline(self, user_id: str):
+        now = datetime.utcnow()
+        entry = self._entry(user_id, now)
+        if entry.is_online:
+            self.transitions += 1
+        entry.is_online = False
+        entry.last_seen = now
+        entry.offline_timestamp = now
+        entry.dirty = True
+
+    def touch(self, user_id: str):
+        """Heartbeat: keep last_seen current in memory, persisting it only at PRESENCE_LAST_SEEN_RESOLUTION"""
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return
+        now = datetime.utcnow()
+        entry.last_seen = now
+        if (now - entry.persisted_at).total_seconds() >= PRESENCE_LAST_SEEN_RESOLUTION:
+            entry.dirty = True
+
+    def forget(self, user_id: str):
+        """Stop tracking a user whose presence is owned by another worker"""
+        self.entries.pop(user_id, None)
+
+    def overlay(self, user: dict) -> dict:
+        entry = self.entries.get(user.get("id"))
+        if entry is None:
+            return user
+        return {**user, "is_online": entry.is_online, "last_seen": entry.last_seen}
+
+    def overlay_response(self, user: "UserResponse") -> "UserResponse":
+        entry = self.entries.get(user.id)
+        if entry is None or (entry.is_online == user.is_online and entry.last_seen == user.last_seen):
+            return user
+        return user.copy(update={"is_online": entry.is_online, "last_seen": entry.last_seen})
+
+    async def flush(self):
+        dirty = [(user_id, entry) for user_id, entry in self.entries.items() if entry.dirty]
+        if not dirty:
+            return
+        now = datetime.utcnow()
+        requests = []
+        for user_id, entry in dirty:
+            update = {"is_online": entry.is_online, "last_seen": entry.last_seen}
+            if not entry.is_online and entry.offline_timestamp is not None:
+                update["offline_timestamp"] = entry.offline_timestamp
+            requests.append(UpdateOne({"id": user_id}, {"$set": update}))
+            entry.dirty = False
+            entry.persisted_at = now
+        try:
+            await db.users.bulk_write(requests, ordered=False)
+        except Exception as e:
+            logger.error(f"Presence flush failed: {e}")
+            for _, entry in dirty:
+                entry.dirty = True
+            return
+        self.flushes += 1
+        self.flushed_writes += len(requests)
+        # Offline users are fully described by Mongo once written back
+        for user_id, entry in dirty:
+            if not entry.is_online and not entry.dirty and self.entries.get(user_id) is entry:
+                del self.entries[user_id]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "tracked": len(self.entries),
+            "online": sum(1 for entry in self.entries.values() if entry.is_online),
+            "dirty": sum(1 for entry in self.entries.values() if entry.dirty),
+            "transitions": self.transitions,
+            "flushes": self.flushes,
+            "flushed_writes": self.flushed_writes
+        }
+
+presence = PresenceService(PRESENCE_FLUSH_INTERVAL)
+
 # WebSocket connection manager
+WS_SEND_QUEUE_SIZE = int(os.environ.get('WS_SEND_QUEUE_SIZE', '256'))
+# What to do when a client's outbound queue is full: drop | coalesce | disconnect
+WS_OVERFLOW_POLICY = os.environ.get('WS_OVERFLOW_POLICY', 'coalesce')
+# A connection idle for WS_PING_INTERVAL gets a ping; one still silent WS_PING_TIMEOUT later is reaped
+WS_PING_INTERVAL = float(os.environ.get('WS_PING_INTERVAL', '25'))  # seconds
+WS_PING_TIMEOUT = float(os.environ.get('WS_PING_TIMEOUT', '20'))  # seconds
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def encode_json(payload) -> bytes:
+    if orjson is not None:
+        # orjson renders naive datetimes in the same ISO format as json_default
+        return orjson.dumps(payload)
+    return json.dumps(payload, default=json_default, ensure_ascii=False).encode()
+
+def msgpack_default(value):
+    # Same wire schema as JSON: datetimes travel as ISO strings
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not MessagePack serializable")
+
+def decode_json(data: Union[bytes, str]):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def msgpack_with_seq(packed: bytes, seq: int) -> bytes:
+    """Prepend a "seq" entry to an encoded map by rewriting only the map header"""
+    first = packed[0]
+    if 0x80 <= first <= 0x8f:
+        size, offset = first & 0x0f, 1
+    elif first == 0xde:
+        size, offset = int.from_bytes(packed[1:3], "big"), 3
+    elif first == 0xdf:
+        size, offset = int.from_bytes(packed[1:5], "big"), 5
+    else:
+        raise ValueError("Event is not a MessagePack map")
+    size += 1
+    if size < 16:
+        header = bytes([0x80 | size])
+    elif size < 0x10000:
+        header = b"\xde" + size.to_bytes(2, "big")
+    else:
+        header = b"\xdf" + size.to_bytes(4, "big")
+    return header + msgpack.packb("seq") + msgpack.packb(seq) + packed[offset:]
+
+class OutboundEvent:
+    """A server-to-client event serialized at most once per wire format and shared by every recipient queue"""
+    __slots__ = ("payload", "_data", "_text", "_packed", "_unstamped", "seq", "epoch")
+
+    def __init__(self, payload: Optional[dict] = None, data: Optional[bytes] = None):
+        self.payload = payload
+        self._data = data
+        self._text = None
+        self._packed = None
+        self._unstamped: Optional["OutboundEvent"] = None  # the event with_seq was called on
+        self.seq: Optional[int] = None  # position in the recipient's UserEventLog, once stamped
+        self.epoch: Optional[str] = None
+
+    @property
+    def data(self) -> bytes:
+        if self._data is None:
+            self._data = encode_json(self.payload)
+        return self._data
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.data.decode()
+        return self._text
+
+    @property
+    def packed(self) -> bytes:
+        """MessagePack encoding, only built when a msgpack connection sends the event"""
+        if self._packed is None:
+            if self._unstamped is not None:
+                self._packed = msgpack_with_seq(self._unstamped.packed, self.seq)
+            else:
+                # Events relayed by another worker arrive as JSON bytes only
+                payload = self.payload if self.payload is not None else decode_json(self.data)
+                self._packed = msgpack.packb(payload, default=msgpack_default, use_bin_type=True)
+        return self._packed
+
+    def with_seq(self, seq: int, epoch: Optional[str] = None) -> "OutboundEvent":
+        """Copy of the event with a leading "seq" field, spliced into the encoded bytes"""
+        data = self.data
+        separator = b"" if data == b"{}" else b","
+        stamped = OutboundEvent(data=b'{"seq":%d%s' % (seq, separator) + data[1:])
+        stamped.seq = seq
+        stamped.epoch = epoch
+        stamped._unstamped = self
+        return stamped
+
+def as_event(message: Union[dict, OutboundEvent]) -> OutboundEvent:
+    return message if isinstance(message, OutboundEvent) else OutboundEvent(message)
+
+PING_EVENT = OutboundEvent({"type": "ping"})
+PONG_EVENT = OutboundEvent({"type": "pong"})
+
+class ClientConnection:
+    """A live WebSocket with a bounded outbound queue drained by its own writer task.
+
+    Fan-out only appends to the queue, so a slow socket never delays delivery
+    to other clients or the request that produced the event.
+    """
+    transport = "websocket"
+
+    def __init__(self, connection_id: str, user_id: str, websocket: WebSocket, manager: "ConnectionManager",
+                 protocol: str = "json"):
+        self.connection_id = connection_id
+        self.user_id = user_id
+        self.websocket = websocket
+        self.manager = manager
+        self.protocol = protocol  # "json" text frames or "msgpack" binary frames
+        self.queue: deque = deque()  # (coalesce_key, OutboundEvent)
+        self.ready = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.closed = False
+        self.last_activity = time.monotonic()  # last inbound frame (or completed stream write)
+        self.rate_buckets: Optional[list] = None  # inbound TokenBuckets per frame kind, created on first use
+        self.writer_task = asyncio.create_task(self._writer())
+
+    def enqueue(self, event: OutboundEvent, coalesce_key: Optional[str] = None) -> bool:
+        if self.closed:
+            return False
+        if len(self.queue) >= WS_SEND_QUEUE_SIZE and not self._handle_overflow(coalesce_key):
+            return False
+        self.queue.append((coalesce_key, event))
+        self.ready.set()
+        return True
+
+    def _handle_overflow(self, coalesce_key: Optional[str]) -> bool:
+        """Apply the overflow policy; returns whether the new event may still be queued"""
+        if WS_OVERFLOW_POLICY == 'disconnect':
+            self.manager.schedule_disconnect(self)
+            return False
+        if WS_OVERFLOW_POLICY == 'coalesce':
+            # A queued event with the same key is superseded by the new one, otherwise the oldest event goes
+            if coalesce_key is not None:
+                for index, (key, _) in enumerate(self.queue):
+                    if key == coalesce_key:
+                        del self.queue[index]
+                        self.coalesced += 1
+                        return True
+            self.queue.popleft()
+            self.dropped += 1
+            return True
+        self.dropped += 1
+        return False
+
+    async def _writer(self):
+        try:
+            while True:
+                while not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+                _, event = self.queue.popleft()
+                await self.send(event)
+                self.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"WebSocket send failed for {self.user_id}: {e}")
+            self.manager.schedule_disconnect(self)
+
+    async def send(self, event: OutboundEvent):
+        if self.protocol == "msgpack":
+            await self.websocket.send_bytes(event.packed)
+        else:
+            await self.websocket.send_text(event.text)
+
+    async def receive(self) -> dict:
+        """Next inbound frame, decoded; text frames are JSON on either protocol"""
+        message = await self.websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        if message.get("text") is not None:
+            return decode_json(message["text"])
+        if self.protocol == "msgpack":
+            return msgpack.unpackb(message["bytes"], raw=False)
+        return decode_json(message["bytes"])
+
+    async def close_transport(self, code: int):
+        await self.websocket.close(code=code)
+
+    def send_ping(self):
+        self.enqueue(PING_EVENT, coalesce_key="ping")
+
+    def footprint(self) -> int:
+        """Approximate bytes held by this connection: the object, its queue and queued payloads"""
+        return (
+            sys.getsizeof(self) + sys.getsizeof(self.__dict__) + sys.getsizeof(self.queue)
+            + sum(len(event.data) for _, event in self.queue)
+        )
+
+    async def close(self):
+        self.closed = True
+        self.queue.clear()
+        if self.writer_task is not asyncio.current_task():
+            self.writer_task.cancel()
+
+SSE_KEEPALIVE_INTERVAL = float(os.environ.get('SSE_KEEPALIVE_INTERVAL', '15'))  # seconds
+
+class EventStreamConnection(ClientConnection):
+    """A Server-Sent Events client on the same fan-out path as WebSocket clients.
+
+    The writer task hands formatted frames to the streaming response through a
+    one-slot queue, so the bounded outbound queue and its overflow policy apply
+    unchanged. Stamped events carry `id: <epoch>:<seq>` for Last-Event-ID resume.
+    """
+    transport = "sse"
+
+    def __init__(self, connection_id: str, user_id: str, manager: "ConnectionManager"):
+        self.frames: asyncio.Queue = asyncio.Queue(maxsize=1)
+        super().__init__(connection_id, user_id, None, manager)
+
+    async def send(self, event: OutboundEvent):
+        if event.seq is not None:
+            frame = f"id: {event.epoch}:{event.seq}\ndata: {event.text}\n\n"
+        else:
+            frame = f"data: {event.text}\n\n"
+        await self.frames.put(frame)
+
+    async def close_transport(self, code: int):
+        # close() ends the stream
+        pass
+
+    def send_ping(self):
+        # The stream sends its own keepalive comments
+        pass
+
+    async def close(self):
+        await super().close()
+        while not self.frames.empty():
+            self.frames.get_nowait()
+        self.frames.put_nowait(None)
+
+    async def stream(self):
+        try:
+            while True:
+                try:
+                    frame = await asyncio.wait_for(self.frames.get(), SSE_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    # Comment line keeps proxies from timing out an idle stream
+                    presence.touch(self.user_id)
+                    yield ": keepalive\n\n"
+                    self.last_activity = time.monotonic()
+                    continue
+                if frame is None:
+                    return
+                yield frame
+                # Resumed only once the previous frame was written to the client
+                self.last_activity = time.monotonic()
+        finally:
+            await self.manager.disconnect(self.connection_id, self.user_id)
+
+REPLAY_BUFFER_SIZE = int(os.environ.get('REPLAY_BUFFER_SIZE', '256'))
+REPLAY_BUFFER_USERS = int(os.environ.get('REPLAY_BUFFER_USERS', '10000'))
+
+class UserEventLog:
+    """Per-user event sequence plus a bounded buffer of recent events for resume.
+
+    `epoch` identifies this log; a client resuming against another epoch (log
+    evicted, server restarted) must resync since the sequence started over.
+    """
+    __slots__ = ("epoch", "next_seq", "events")
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:12]
+        self.next_seq = 1
+        self.events: deque = deque(maxlen=REPLAY_BUFFER_SIZE)  # (seq, OutboundEvent)
+
+    def append(self, event: OutboundEvent) -> OutboundEvent:
+        stamped = event.with_seq(self.next_seq, self.epoch)
+        self.events.append((self.next_seq, stamped))
+        self.next_seq += 1
+        return stamped
+
+    def since(self, last_seq: int) -> Optional[List[OutboundEvent]]:
+        """Events after last_seq, or None when some of them have already left the buffer"""
+        if last_seq >= self.next_seq:
+            return None
+        oldest_seq = self.events[0][0] if self.events else self.next_seq
+        if last_seq + 1 < oldest_seq:
+            return None
+        return [event for seq, event in self.events if seq > last_seq]
+
+def negotiate_subprotocol(websocket: WebSocket) -> Optional[str]:
+    """Pick "msgpack" when the client offers it and the encoder is installed; JSON stays the default"""
+    offered = websocket.scope.get("subprotocols", [])
+    if "msgpack" in offered and msgpack is not None:
+        return "msgpack"
+    if "json" in offered:
+        return "json"
+    return None
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.user_connections: Dict[str, str] = {}  # user_id -> connection_id
-
-    async def connect(self, websocket: WebSocket, user_id: str):
-        await websocket.accept()
-        connection_id = str(uuid.uuid4())
-        self.active_connections[connection_id] = websocket
-        self.user_connections[user_id] = connection_id
-        
-        # Update user online status
-        await db.users.update_one(
-            {"id": user_id},
-            {"$set": {"is_online": True, "last_seen": datetime.utcnow()}}
-        )
+        self.active_connections: Dict[str, ClientConnection] = {}
+        self.user_connections: Dict[str, Set[str]] = {}  # user_id -> live connection_ids (one per tab/device)
+        # user_id -> UserEventLog; kept after disconnect so a reconnecting client can resume
+        self.event_logs = LRUCache(REPLAY_BUFFER_USERS)
+        self.replayed = 0
+        self.resyncs = 0
+        self.heartbeat_task: Optional[asyncio.Task] = None
+        self.pings_sent = 0
+        self.reaped = 0
+        self.reclaimed_bytes = 0
+        self.last_reap: Optional[dict] = None
+
+    async def connect(self, websocket: WebSocket, user_id: str, last_seq: Optional[int] = None, epoch: Optional[str] = None):
+        subprotocol = negotiate_subprotocol(websocket)
+        await websocket.accept(subprotocol=subprotocol)
+        connection = ClientConnection(str(uuid.uuid4()), user_id, websocket, self, protocol=subprotocol or "json")
+        return self.register(connection, last_seq, epoch)
+
+    def register(self, connection: ClientConnection, last_seq: Optional[int] = None, epoch: Optional[str] = None) -> str:
+        """Attach an accepted connection (WebSocket or event stream) to its user's fan-out"""
+        connection_id = connection.connection_id
+        user_id = connection.user_id
+        self.active_connections[connection_id] = connection
+        user_connection_ids = self.user_connections.setdefault(user_id, set())
+        user_connection_ids.add(connection_id)
+        # No await between registering and replaying, so missed events are queued before live ones
+        self._resume(connection, last_seq, epoch)
+        
+        # Update user online status when the first connection opens
+        if len(user_connection_ids) == 1:
+            fanout_bus.user_connected(user_id)
+            presence.set_online(user_id)
+        
+        # Push messages that arrived while the user was offline
+        asyncio.create_task(deliver_offline_inbox(connection_id, user_id))
         
         return connection_id
 
     async def disconnect(self, connection_id: str, user_id: str):
-        if connection_id in self.active_connections:
-            del self.active_connections[connection_id]
+        connection = self.active_connections.pop(connection_id, None)
+        if connection is None:
+            return
+        await connection.close()
         
-        if user_id in self.user_connections:
+        user_connection_ids = self.user_connections.get(user_id)
+        if user_connection_ids is not None:
+            user_connection_ids.discard(connection_id)
+            if user_connection_ids:
+                # Other tabs or devices are still connected
+                return
             del self.user_connections[user_id]
+            fanout_bus.user_disconnected(user_id)
+            if fanout_bus.is_connected_elsewhere(user_id):
+                # Still online through a connection owned by another worker, which tracks presence
+                presence.forget(user_id)
+                return
             
-        # Update user offline status
-        await db.users.update_one(
-            {"id": user_id},
-            {"$set": {"is_online": False, "last_seen": datetime.utcnow()}}
-        )
+        # Update user offline status once the last connection closed
+        presence.set_offline(user_id)
 
-    async def send_personal_message(self, message: dict, user_id: str):
-        if user_id in self.user_connections:
-            connection_id = self.user_connections[user_id]
-            if connection_id in self.active_connections:
-                websocket = self.active_connections[connection_id]
-                try:
-                    await websocket.send_text(json.dumps(message))
-                    return True
-                except:
-                    await self.disconnect(connection_id, user_id)
+    def _event_log(self, user_id: str) -> UserEventLog:
+        log = self.event_logs.get(user_id)
+        if log is None:
+            log = UserEventLog()
+            self.event_logs.set(user_id, log)
+        return log
+
+    def _resume(self, connection: ClientConnection, last_seq: Optional[int], epoch: Optional[str]):
+        """Tell the client its session position and replay what it missed since last_seq"""
+        log = self._event_log(connection.user_id)
+        if last_seq is not None:
+            missed = log.since(last_seq) if epoch == log.epoch else None
+            if missed is None:
+                # The gap is older than the buffer: the client has to refetch its chats
+                self.resyncs += 1
+                connection.enqueue(OutboundEvent({"type": "resync_required", "epoch": log.epoch, "seq": log.next_seq - 1}))
+                return
+            for event in missed:
+                connection.enqueue(event)
+            self.replayed += len(missed)
+        connection.enqueue(OutboundEvent({"type": "session", "epoch": log.epoch, "seq": log.next_seq - 1}))
+
+    def touch(self, connection_id: str):
+        connection = self.active_connections.get(connection_id)
+        if connection is not None:
+            connection.last_activity = time.monotonic()
+
+    def start_heartbeat(self):
+        if self.heartbeat_task is None:
+            self.heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def stop_heartbeat(self):
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            try:
+                await self.heartbeat_task
+            except asyncio.CancelledError:
+                pass
+            self.heartbeat_task = None
+
+    async def _heartbeat(self):
+        tick = max(min(WS_PING_INTERVAL, WS_PING_TIMEOUT) / 2, 0.5)
+        while True:
+            await asyncio.sleep(tick)
+            try:
+                await self.reap_stale()
+            except Exception as e:
+                logger.error(f"Connection reaper failed: {e}")
+
+    async def reap_stale(self) -> dict:
+        """Ping idle connections and evict, in one pass, those that never answered"""
+        now = time.monotonic()
+        stale = []
+        for connection in self.active_connections.values():
+            idle = now - connection.last_activity
+            if idle >= WS_PING_INTERVAL + WS_PING_TIMEOUT:
+                stale.append(connection)
+            elif idle >= WS_PING_INTERVAL and not connection.closed:
+                connection.send_ping()
+                self.pings_sent += 1
+        if not stale:
+            return {"reaped": 0, "reclaimed_bytes": 0}
+        
+        reclaimed = sum(connection.footprint() for connection in stale)
+        for connection in stale:
+            # Stop fan-out to the dead socket before the close handshake, which may never complete
+            connection.closed = True
+        
+        async def evict(connection: ClientConnection):
+            try:
+                await asyncio.wait_for(connection.close_transport(1001), timeout=1)
+            except Exception:
+                pass
+            await self.disconnect(connection.connection_id, connection.user_id)
+        
+        await asyncio.gather(*[evict(connection) for connection in stale])
+        self.reaped += len(stale)
+        self.reclaimed_bytes += reclaimed
+        self.last_reap = {
+            "at": datetime.utcnow().isoformat(),
+            "reaped": len(stale),
+            "reclaimed_bytes": reclaimed
+        }
+        logger.info(f"Reaped {len(stale)} stale connections, reclaimed ~{reclaimed} bytes")
+        return self.last_reap
+
+    def schedule_disconnect(self, connection: ClientConnection):
+        """Disconnect from synchronous code paths (fan-out, writer failures)"""
+        if connection.closed:
+            return
+        connection.closed = True
+        asyncio.create_task(self._close_slow_connection(connection))
+
+    async def _close_slow_connection(self, connection: ClientConnection):
+        try:
+            await connection.close_transport(1013)  # Try again later
+        except Exception:
+            pass
+        await self.disconnect(connection.connection_id, connection.user_id)
+
+    def send_personal_message(self, message: Union[dict, OutboundEvent], user_id: str, coalesce_key: Optional[str] = None,
+                              transient: bool = False) -> bool:
+        """Route an event to every connection of the user, on this worker or another one.
+
+        Pass the same OutboundEvent for every recipient of a fan-out so it is
+        serialized only once. Transient events (typing) are only delivered to
+        live connections and never replayed.
+        """
+        return fanout_bus.publish(user_id, as_event(message), coalesce_key, transient)
+
+    def deliver_local(self, event: OutboundEvent, user_id: str, coalesce_key: Optional[str] = None,
+                      transient: bool = False) -> bool:
+        """Queue an event for the user's connections on this worker without waiting for the network.
+
+        The event is stamped with the user's next sequence number and kept in
+        the replay buffer, also while the user is briefly disconnected.
+        """
+        if transient:
+            delivered = False
+            for connection_id in self.user_connections.get(user_id, ()):
+                if self.send_to_connection(connection_id, event, coalesce_key):
+                    delivered = True
+            return delivered
+        log = self.event_logs.get(user_id)
+        if log is None:
+            if user_id not in self.user_connections:
+                return False
+            # The log of a connected user was evicted; announce the new epoch before its first event
+            log = self._event_log(user_id)
+            session = OutboundEvent({"type": "session", "epoch": log.epoch, "seq": 0})
+            for connection_id in self.user_connections[user_id]:
+                self.send_to_connection(connection_id, session)
+        event = log.append(event)
+        delivered = False
+        for connection_id in self.user_connections.get(user_id, ()):
+            if self.send_to_connection(connection_id, event, coalesce_key):
+                delivered = True
+        return delivered
+
+    def send_to_connection(self, connection_id: str, message: Union[dict, OutboundEvent], coalesce_key: Optional[str] = None) -> bool:
+        connection = self.active_connections.get(connection_id)
+        if connection is None:
+            return False
+        return connection.enqueue(as_event(message), coalesce_key)
+
+    def stats(self) -> dict:
+        """Aggregates only; nothing identifies a user or a connection"""
+        depths = [len(connection.queue) for connection in self.active_connections.values()]
+        by_kind: Dict[str, int] = {}
+        for connection in self.active_connections.values():
+            kind = f"{connection.transport}/{connection.protocol}"
+            by_kind[kind] = by_kind.get(kind, 0) + 1
+        return {
+            "active_connections": len(depths),
+            "connected_users": len(self.user_connections),
+            "connections_by_kind": by_kind,
+            "overflow_policy": WS_OVERFLOW_POLICY,
+            "queue_limit": WS_SEND_QUEUE_SIZE,
+            "total_queue_depth": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "queue_depth_histogram": queue_depth_histogram(depths),
+            "sent": sum(connection.sent for connection in self.active_connections.values()),
+            "dropped": sum(connection.dropped for connection in self.active_connections.values()),
+            "coalesced": sum(connection.coalesced for connection in self.active_connections.values()),
+            "event_logs": self.event_logs.stats(),
+            "replayed_events": self.replayed,
+            "resyncs": self.resyncs,
+            "heartbeat": {
+                "ping_interval": WS_PING_INTERVAL,
+                "ping_timeout": WS_PING_TIMEOUT,
+                "pings_sent": self.pings_sent,
+                "reaped": self.reaped,
+                "reclaimed_bytes": self.reclaimed_bytes,
+                "last_reap": self.last_reap
+            }
+        }
+
+QUEUE_DEPTH_BUCKETS = (0, 1, 10, 100, 1000)
+
+def queue_depth_histogram(depths: List[int]) -> Dict[str, int]:
+    """Connection counts per send queue depth bucket ("0", "1-9", ..., "1000+")"""
+    labels = [
+        str(low) if high == low + 1 else f"{low}-{high - 1}"
+        for low, high in zip(QUEUE_DEPTH_BUCKETS, QUEUE_DEPTH_BUCKETS[1:])
+    ] + [f"{QUEUE_DEPTH_BUCKETS[-1]}+"]
+    histogram = dict.fromkeys(labels, 0)
+    for depth in depths:
+        histogram[labels[sum(1 for low in QUEUE_DEPTH_BUCKETS if depth >= low) - 1]] += 1
+    return histogram
+
+# Cross-process fan-out
+FANOUT_BUS = os.environ.get('FANOUT_BUS', 'local')  # local | unix
+# Workers trust every socket in this directory, so it must be private to the server's user
+FANOUT_SOCKET_DIR = Path(os.environ.get('FANOUT_SOCKET_DIR') or (
+    Path(os.environ['XDG_RUNTIME_DIR']) / 'basemapp-fanout' if os.environ.get('XDG_RUNTIME_DIR')
+    else Path('/tmp') / f'basemapp-fanout-{os.getuid()}'
+))
+FANOUT_PEER_BUFFER_LIMIT = int(os.environ.get('FANOUT_PEER_BUFFER_LIMIT', str(8 * 1024 * 1024)))
+
+class InProcessFanoutBus:
+    """Single-worker bus: every recipient is connected to this process"""
+    def __init__(self, manager: "ConnectionManager"):
+        self.manager = manager
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def publish(self, user_id: str, event: OutboundEvent, coalesce_key: Optional[str] = None, transient: bool = False) -> bool:
+        return self.manager.deliver_local(event, user_id, coalesce_key, transient)
+
+    def user_connected(self, user_id: str):
+        pass
+
+    def user_disconnected(self, user_id: str):
+        pass
+
+    def is_connected_elsewhere(self, user_id: str) -> bool:
         return False
 
+    def stats(self) -> dict:
+        return {"backend": "local"}
+
+class UnixSocketFanoutBus(InProcessFanoutBus):
+    """Routes events between uvicorn workers on one host over Unix domain sockets.
+
+    Every worker listens on `<FANOUT_SOCKET_DIR>/<pid>.sock` and keeps one
+    stream per peer. Peers are not authenticated on the wire: the directory
+    must be owned by the server's user and closed to everyone else, which
+    start() checks before listening. Workers announce the users whose sockets they own
+    (claim/release), so an event is written only to the workers that own the
+    recipient instead of being broadcast to all of them. Frames are a 4-byte
+    big-endian length followed by a JSON header; `deliver` frames are followed
+    by the already-serialized event bytes (header `size`), so events are never
+    re-encoded on their way to another worker.
+    """
+    def __init__(self, manager: "ConnectionManager", socket_dir: Path):
+        super().__init__(manager)
+        self.socket_dir = socket_dir
+        self.worker_id = str(os.getpid())
+        self.socket_path = socket_dir / f"{self.worker_id}.sock"
+        self.server = None
+        self.peers: Dict[str, asyncio.StreamWriter] = {}  # worker_id -> stream
+        self.routes: Dict[str, Set[str]] = {}  # user_id -> worker_ids owning a connection
+        self.forwarded = 0
+        self.received = 0
+        self.dropped = 0
+
+    async def start(self):
+        self.socket_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        self._check_socket_dir()
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+        self.server = await asyncio.start_unix_server(self._handle_incoming, path=str(self.socket_path))
+        os.chmod(self.socket_path, 0o600)
+        for peer_path in self.socket_dir.glob("*.sock"):
+            if peer_path != self.socket_path:
+                await self._connect_peer(peer_path)
+        logger.info(f"Fan-out bus listening on {self.socket_path} with {len(self.peers)} peers")
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+        for writer in self.peers.values():
+            writer.close()
+        self.peers.clear()
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+
+    def _check_socket_dir(self):
+        """Refuse a directory another user could plant sockets in or connect through"""
+        info = os.lstat(self.socket_dir)
+        if not stat.S_ISDIR(info.st_mode):
+            raise RuntimeError(f"Fan-out socket dir {self.socket_dir} is not a directory")
+        if info.st_uid != os.getuid():
+            raise RuntimeError(f"Fan-out socket dir {self.socket_dir} is owned by uid {info.st_uid}, not {os.getuid()}")
+        if info.st_mode & 0o077:
+            raise RuntimeError(f"Fan-out socket dir {self.socket_dir} is accessible to other users (mode {oct(info.st_mode & 0o777)})")
+
+    async def _connect_peer(self, peer_path: Path):
+        try:
+            reader, writer = await asyncio.open_unix_connection(str(peer_path))
+        except (ConnectionRefusedError, FileNotFoundError):
+            # Left behind by a worker that is gone
+            peer_path.unlink(missing_ok=True)
+            return
+        self._send(writer, {"op": "hello", "worker_id": self.worker_id, "users": list(self.manager.user_connections)})
+        asyncio.create_task(self._read_peer(reader, writer))
+
+    async def _handle_incoming(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        await self._read_peer(reader, writer)
+
+    async def _read_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer_id = None
+        try:
+            while True:
+                header = await reader.readexactly(4)
+                frame = json.loads(await reader.readexactly(int.from_bytes(header, "big")))
+                op = frame["op"]
+                if peer_id is None and op not in ("hello", "welcome"):
+                    # Routes and deliveries are only accepted from an introduced worker
+                    break
+                if op == "deliver":
+                    event = OutboundEvent(data=await reader.readexactly(frame["size"]))
+                    self.received += 1
+                    self.manager.deliver_local(event, frame["user_id"], frame.get("coalesce_key"), frame.get("transient", False))
+                elif op == "claim":
+                    self.routes.setdefault(frame["user_id"], set()).add(peer_id)
+                elif op == "release":
+                    self._drop_route(frame["user_id"], peer_id)
+                elif op in ("hello", "welcome"):
+                    peer_id = frame["worker_id"]
+                    self.peers[peer_id] = writer
+                    for user_id in frame["users"]:
+                        self.routes.setdefault(user_id, set()).add(peer_id)
+                    if op == "hello":
+                        self._send(writer, {"op": "welcome", "worker_id": self.worker_id, "users": list(self.manager.user_connections)})
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # Two workers starting together may open a stream each way; only the registered one owns the routes
+            if peer_id is not None and self.peers.get(peer_id) is writer:
+                self.peers.pop(peer_id)
+                for user_id in list(self.routes):
+                    self._drop_route(user_id, peer_id)
+            writer.close()
+
+    def _drop_route(self, user_id: str, worker_id: str):
+        workers = self.routes.get(user_id)
+        if workers is not None:
+            workers.discard(worker_id)
+            if not workers:
+                del self.routes[user_id]
+
+    def _send(self, writer: asyncio.StreamWriter, frame: dict, body: bytes = b"") -> bool:
+        if writer.transport.get_write_buffer_size() > FANOUT_PEER_BUFFER_LIMIT:
+            # The peer is not keeping up; shed instead of buffering without bound
+            self.dropped += 1
+            return False
+        header = json.dumps(frame).encode()
+        writer.write(len(header).to_bytes(4, "big") + header + body)
+        return True
+
+    def _broadcast(self, frame: dict):
+        for writer in self.peers.values():
+            self._send(writer, frame)
+
+    def publish(self, user_id: str, event: OutboundEvent, coalesce_key: Optional[str] = None, transient: bool = False) -> bool:
+        delivered = self.manager.deliver_local(event, user_id, coalesce_key, transient)
+        for worker_id in self.routes.get(user_id, ()):
+            writer = self.peers.get(worker_id)
+            if writer is not None and self._send(writer, {
+                "op": "deliver", "user_id": user_id, "coalesce_key": coalesce_key,
+                "transient": transient, "size": len(event.data)
+            }, event.data):
+                self.forwarded += 1
+                delivered = True
+        return delivered
+
+    def user_connected(self, user_id: str):
+        self._broadcast({"op": "claim", "user_id": user_id})
+
+    def user_disconnected(self, user_id: str):
+        self._broadcast({"op": "release", "user_id": user_id})
+
+    def is_connected_elsewhere(self, user_id: str) -> bool:
+        return bool(self.routes.get(user_id))
+
+    def stats(self) -> dict:
+        return {
+            "backend": "unix",
+            "worker_id": self.worker_id,
+            "peers": len(self.peers),
+            "remote_users": len(self.routes),
+            "forwarded": self.forwarded,
+            "received": self.received,
+            "dropped": self.dropped
+        }
+
 manager = ConnectionManager()
+fanout_bus = (
+    UnixSocketFanoutBus(manager, FANOUT_SOCKET_DIR) if FANOUT_BUS == 'unix'
+    else InProcessFanoutBus(manager)
+)
 
 # Models
 class User(BaseModel):
@@ -138,6 +1073,7 @@ class Chat(BaseModel):
     name: Optional[str] = None  # for group chats
     created_at: datetime = Field(default_factory=datetime.utcnow)
     last_message_at: datetime = Field(default_factory=datetime.utcnow)
+    unread: Dict[str, int] = Field(default_factory=dict)  # per-participant unread counters
 
 class Message(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -152,17 +1088,126 @@ class Message(BaseModel):
     status: str = "sent"  # sent, delivered, read
     delivered_at: Optional[datetime] = None
     read_at: Optional[datetime] = None
+    # Per-chat change sequence: seq is assigned on creation, change_seq on every later change
+    seq: Optional[int] = None
+    change_seq: Optional[int] = None
+    client_msg_id: Optional[str] = None  # client-generated id that makes retries idempotent
+    recipient_ids: List[str] = []  # participants other than the sender, for the offline inbox
 
 class MessageCreate(BaseModel):
     chat_id: str
     content: str
     message_type: str = "text"
     replied_to: Optional[str] = None
+    client_msg_id: Optional[str] = None
 
 class Token(BaseModel):
     access_token: str
     token_type: str
 
+class SyncRequest(BaseModel):
+    cursors: Dict[str, int] = {}  # chat_id -> last change sequence seen by the client
+    limit: int = 200
+
+# Indexes required by the query shapes issued by the handlers below
+INDEXES = {
+    "users": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("email", ASCENDING)], unique=True, name="email_unique"),
+        IndexModel([("username", ASCENDING)], unique=True, name="username_unique"),
+    ],
+    "users_pending": [
+        IndexModel([("email", ASCENDING), ("verification_code", ASCENDING)], name="email_verification_code"),
+    ],
+    "chats": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("participants", ASCENDING)], name="participants"),
+        IndexModel([("last_message.id", ASCENDING)], name="last_message_id"),
+    ],
+    "messages": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("chat_id", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)], name="chat_id_timestamp_id"),
+        IndexModel([("chat_id", ASCENDING), ("change_seq", ASCENDING)], name="chat_id_change_seq"),
+        IndexModel(
+            [("sender_id", ASCENDING), ("client_msg_id", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"client_msg_id": {"$type": "string"}},
+            name="sender_id_client_msg_id_unique"
+        ),
+        IndexModel(
+            [("recipient_ids", ASCENDING), ("status", ASCENDING), ("timestamp", ASCENDING)],
+            name="recipient_ids_status_timestamp"
+        ),
+    ],
+    "message_tombstones": [
+        IndexModel([("chat_id", ASCENDING), ("change_seq", ASCENDING)], name="chat_id_change_seq"),
+    ],
+}
+
+# (collection, filter, sort) for every indexed query the handlers issue; used by verify_index_usage
+QUERY_SHAPES = [
+    ("users", {"id": "__explain__"}, None),
+    ("users", {"email": "__explain__"}, None),
+    ("users", {"username": "__explain__"}, None),
+    ("users_pending", {"email": "__explain__"}, None),
+    ("users_pending", {"email": "__explain__", "verification_code": "000000"}, None),
+    ("chats", {"id": "__explain__"}, None),
+    ("chats", {"participants": "__explain__"}, None),
+    ("chats", {"id": "__explain__", "participants": "__explain__"}, None),
+    ("chats", {"participants": {"$all": ["__explain__", "__explain2__"]}, "chat_type": "private"}, None),
+    ("chats", {"last_message.id": {"$in": ["__explain__"]}}, None),
+    ("messages", {"id": "__explain__"}, None),
+    ("messages", {"chat_id": "__explain__"}, [("timestamp", ASCENDING)]),
+    ("messages", {"chat_id": "__explain__"}, [("timestamp", DESCENDING)]),
+    ("messages", {"chat_id": "__explain__"}, [("timestamp", DESCENDING), ("id", DESCENDING)]),
+    ("messages", {"chat_id": "__explain__", "$or": [
+        {"timestamp": {"$lt": datetime(2000, 1, 1)}},
+        {"timestamp": datetime(2000, 1, 1), "id": {"$lt": "__explain__"}}
+    ]}, [("timestamp", DESCENDING), ("id", DESCENDING)]),
+    ("messages", {"chat_id": {"$in": ["__explain__", "__explain2__"]}}, [("chat_id", DESCENDING), ("timestamp", DESCENDING)]),
+    ("users", {"id": {"$in": ["__explain__", "__explain2__"]}}, None),
+    ("messages", {"chat_id": "__explain__", "change_seq": {"$gt": 0}}, [("change_seq", ASCENDING)]),
+    ("message_tombstones", {"chat_id": "__explain__", "change_seq": {"$gt": 0}}, [("change_seq", ASCENDING)]),
+    ("messages", {"sender_id": "__explain__", "client_msg_id": "__explain__"}, None),
+    ("messages", {"recipient_ids": "__explain__", "status": "sent"}, [("timestamp", ASCENDING)]),
+]
+
+async def ensure_indexes():
+    """إنشاء الفهارس المطلوبة عند بدء التشغيل"""
+    for collection_name, indexes in INDEXES.items():
+        try:
+            await db[collection_name].create_indexes(indexes)
+        except OperationFailure as e:
+            # Existing duplicates or a conflicting index definition must not stop the server
+            logger.error(f"Failed to create indexes on {collection_name}: {e}")
+
+def _plan_stages(plan: dict):
+    """Yield every stage name in an explain() plan tree"""
+    if not isinstance(plan, dict):
+        return
+    if "stage" in plan:
+        yield plan["stage"]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from _plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _plan_stages(child)
+
+async def verify_index_usage():
+    """Run explain() on each query shape and fail if any of them falls back to COLLSCAN"""
+    collscans = []
+    for collection_name, query, sort in QUERY_SHAPES:
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explanation = await cursor.explain()
+        winning_plan = explanation.get("queryPlanner", {}).get("winningPlan", {})
+        if "COLLSCAN" in set(_plan_stages(winning_plan)):
+            collscans.append(f"{collection_name} {query} sort={sort}")
+    if collscans:
+        raise RuntimeError("Queries without index support: " + "; ".join(collscans))
+    logger.info(f"Index verification passed for {len(QUERY_SHAPES)} query shapes")
+
 # Utility functions
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
@@ -170,6 +1215,53 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
+class PasswordHasher:
+    """Runs bcrypt on a dedicated thread pool so it never blocks the event loop.
+
+    bcrypt releases the GIL while hashing, so threads give real parallelism.
+    Admission is bounded: once `queue_limit` jobs are running or waiting,
+    new requests are shed with 503 instead of piling up behind the pool.
+    """
+    def __init__(self, workers: int, queue_limit: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.queue_limit = queue_limit
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    async def _run(self, func, *args):
+        if self.pending >= self.queue_limit:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="الخادم مشغول حالياً، يرجى المحاولة مرة أخرى",
+                headers={"Retry-After": "1"}
+            )
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(get_password_hash, password)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.executor._max_workers,
+            "queue_limit": self.queue_limit,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "bcrypt_rounds": BCRYPT_ROUNDS
+        }
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE_LIMIT)
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -187,19 +1279,29 @@ async def send_verification_email(email: str, code: str):
     print(f"رمز التحقق لـ {email}: {code}")
     return True
 
+PRINCIPAL_PROJECTION = {"_id": 0, "password_hash": 0, "avatar_url": 0}
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await authenticate_token(credentials.credentials)
+
+async def authenticate_token(token: str) -> UserResponse:
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
         user_id: str = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid token")
         
-        user = await db.users.find_one({"id": user_id})
+        cached_user = principal_cache.get(user_id)
+        if cached_user is not None:
+            return presence.overlay_response(cached_user)
+        
+        user = await db.users.find_one({"id": user_id}, PRINCIPAL_PROJECTION)
         if user is None:
             raise HTTPException(status_code=401, detail="User not found")
         
-        return UserResponse(**user)
+        current_user = UserResponse(**user)
+        principal_cache.set(user_id, current_user)
+        return presence.overlay_response(current_user)
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
@@ -220,7 +1322,7 @@ async def register(user_data: UserCreate):
     verification_code = generate_verification_code()
     
     # Create new user (but not verified yet)
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await password_hasher.hash(user_data.password)
     user = User(
         username=user_data.username,
         email=user_data.email,
@@ -299,8 +1401,8 @@ async def resend_verification(resend_data: ResendVerificationRequest):
 
 @api_router.post("/auth/login", response_model=Token)
 async def login(user_data: UserLogin):
-    user = await db.users.find_one({"email": user_data.email})
-    if not user or not verify_password(user_data.password, user["password_hash"]):
+    user = await db.users.find_one({"email": user_data.email}, {"id": 1, "password_hash": 1})
+    if not user or not await password_hasher.verify(user_data.password, user["password_hash"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     access_token = create_access_token(data={"sub": user["id"]})
@@ -308,28 +1410,38 @@ async def login(user_data: UserLogin):
 
 @api_router.get("/auth/me", response_model=UserResponse)
 async def get_me(current_user: UserResponse = Depends(get_current_user)):
-    return current_user
+    return await with_avatar(current_user)
+
+async def with_avatar(user: UserResponse) -> UserResponse:
+    """The principal is cached without its avatar; load it for responses that return the full profile"""
+    stored = await db.users.find_one({"id": user.id}, {"_id": 0, "avatar_url": 1})
+    return user.copy(update={"avatar_url": (stored or {}).get("avatar_url")})
+
+@api_router.get("/metrics")
+async def get_metrics(current_user: UserResponse = Depends(get_current_user)):
+    """إحصائيات داخلية للأداء"""
+    return {
+        "principal_cache": principal_cache.stats(),
+        "password_hasher": password_hasher.stats(),
+        "websocket": manager.stats(),
+        "fanout_bus": fanout_bus.stats(),
+        "message_writer": message_writer.stats(),
+        "membership_cache": membership_cache.stats(),
+        "presence": presence.stats(),
+        "typing": typing_tracker.stats(),
+        "ws_rate_limits": frame_limiter.stats()
+    }
 
 @api_router.post("/users/update-status")
 async def update_user_status(status_data: UserStatusUpdate, current_user: UserResponse = Depends(get_current_user)):
     """تحديث حالة المستخدم (متصل/غير متصل) مع timestamp دقيق"""
     try:
-        current_time = datetime.utcnow()
-        update_fields = {
-            "is_online": status_data.is_online,
-            "last_seen": current_time
-        }
-        
-        # إذا كان المستخدم غير متصل، تحديث last_seen بشكل دقيق
-        if not status_data.is_online:
-            update_fields["is_online"] = False
-            # إضافة timestamp إضافي للدقة
-            update_fields["offline_timestamp"] = current_time
-        
-        await db.users.update_one(
-            {"id": current_user.id},
-            {"$set": update_fields}
-        )
+        # Only the in-memory presence table changes; it is written back in periodic bulk flushes
+        if status_data.is_online:
+            presence.set_online(current_user.id)
+        else:
+            presence.set_offline(current_user.id)
+        current_time = presence.entries[current_user.id].last_seen
         
         return {
             "message": "تم تحديث الحالة بنجاح", 
@@ -373,13 +1485,16 @@ async def update_profile(profile_data: ProfileUpdateRequest, current_user: UserR
                 {"id": current_user.id},
                 {"$set": update_fields}
             )
+            principal_cache.invalidate(current_user.id)
             
             # Get updated user
             updated_user = await db.users.find_one({"id": current_user.id})
             if updated_user:
-                return UserResponse(**updated_user)
+                return presence.overlay_response(UserResponse(**updated_user))
         
-        return current_user
+        # The frontend sends an otherwise empty update on focus changes as a last_seen ping
+        presence.touch(current_user.id)
+        return await with_avatar(current_user)
         
     except HTTPException:
         raise
@@ -394,18 +1509,20 @@ async def update_message_status(status_data: MessageStatusUpdate, current_user:
         if status_data.status not in ['delivered', 'read']:
             raise HTTPException(status_code=400, detail="حالة غير صحيحة. استخدم 'delivered' أو 'read'")
         
-        # تحديث حالة الرسائل
-        result = await db.messages.update_many(
-            {
-                "id": {"$in": status_data.message_ids},
-                "sender_id": {"$ne": current_user.id}  # لا يمكن تحديث حالة رسائل المستخدم نفسه
-            },
-            {"$set": {"status": status_data.status, "updated_at": datetime.utcnow()}}
-        )
+        query = {
+            "id": {"$in": status_data.message_ids},
+            "sender_id": {"$ne": current_user.id}  # لا يمكن تحديث حالة رسائل المستخدم نفسه
+        }
+        if status_data.status == 'delivered':
+            query["status"] = "sent"
+        messages = await db.messages.find(query, RECEIPT_MESSAGE_PROJECTION).to_list(len(status_data.message_ids))
+        
+        # تحديث حالة الرسائل مع التحقق من العضوية وإشعار المرسلين
+        modified_count = await apply_receipts(current_user.id, status_data.status, messages)
         
         return {
-            "message": f"تم تحديث حالة {result.modified_count} رسالة إلى {status_data.status}",
-            "updated_count": result.modified_count
+            "message": f"تم تحديث حالة {modified_count} رسالة إلى {status_data.status}",
+            "updated_count": modified_count
         }
         
     except HTTPException:
@@ -413,77 +1530,490 @@ async def update_message_status(status_data: MessageStatusUpdate, current_user:
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def format_last_seen(user: dict) -> str:
+    """نص آخر ظهور للمستخدم بالتقويم الميلادي"""
+    if user.get("is_online"):
+        return "متصل"
+    if not user.get("last_seen"):
+        return "منذ فترة"
+    try:
+        last_seen = user["last_seen"]
+        if isinstance(last_seen, str):
+            # Parse ISO format datetime string
+            last_seen = datetime.fromisoformat(last_seen.replace('Z', '+00:00'))
+        elif not isinstance(last_seen, datetime):
+            # If it's not a datetime object, convert it
+            last_seen = datetime.fromisoformat(str(last_seen))
+        
+        now = datetime.utcnow()
+        diff = now - last_seen
+        
+        if diff.days > 30:
+            # Use Gregorian date format for older dates
+            return f"آخر ظهور في {last_seen.strftime('%d %B %Y')}"
+        elif diff.days > 7:
+            return f"منذ {diff.days} يوم"
+        elif diff.days > 0:
+            return f"منذ {diff.days} يوم"
+        elif diff.seconds > 3600:
+            hours = diff.seconds // 3600
+            return f"منذ {hours} ساعة"
+        elif diff.seconds > 60:
+            minutes = diff.seconds // 60
+            return f"منذ {minutes} دقيقة"
+        else:
+            return "منذ قليل"
+    except Exception as e:
+        print(f"Error parsing last_seen: {e}")
+        return "منذ فترة"
+
+CHAT_USER_PROJECTION = {"_id": 0, "id": 1, "username": 1, "is_online": 1, "last_seen": 1, "avatar_url": 1}
+
+async def fetch_last_messages(chat_ids: List[str]) -> Dict[str, dict]:
+    """Last message of every chat in a single aggregation (walks the chat_id+timestamp index backwards)"""
+    if not chat_ids:
+        return {}
+    pipeline = [
+        {"$match": {"chat_id": {"$in": chat_ids}}},
+        {"$sort": {"chat_id": -1, "timestamp": -1}},
+        {"$group": {"_id": "$chat_id", "last_message": {"$first": "$$ROOT"}}},
+    ]
+    last_messages = {}
+    async for row in db.messages.aggregate(pipeline):
+        message = row["last_message"]
+        message.pop("_id", None)
+        last_messages[row["_id"]] = message
+    return last_messages
+
+async def fetch_users_by_id(user_ids: List[str]) -> Dict[str, dict]:
+    """Batch user lookup with the fields the chat list renders"""
+    if not user_ids:
+        return {}
+    users = await db.users.find({"id": {"$in": user_ids}}, CHAT_USER_PROJECTION).to_list(len(user_ids))
+    return {user["id"]: user for user in users}
+
+LAST_MESSAGE_PREVIEW_LENGTH = 120
+
+def build_last_message_preview(message: dict) -> dict:
+    """Compact snapshot of a message embedded in its chat as `last_message`"""
+    return {
+        "id": message["id"],
+        "sender_id": message["sender_id"],
+        "content": message["content"][:LAST_MESSAGE_PREVIEW_LENGTH],
+        "message_type": message.get("message_type", "text"),
+        "status": message.get("status", "sent"),
+        "timestamp": message["timestamp"],
+        "seq": message.get("seq")
+    }
+
+CHAT_SEQ_PROJECTION = {"_id": 0, "id": 1, "participants": 1, "seq": 1, "last_message.id": 1}
+
+# Sequences still uncommitted this long after allocation belong to a writer that died
+# between allocating and committing, and are skipped
+CHAT_SEQ_STALL_TIMEOUT = float(os.environ.get('CHAT_SEQ_STALL_TIMEOUT', '30'))  # seconds
+
+async def allocate_chat_seq(chat_id: str, update: Optional[Union[dict, list]] = None, count: int = 1) -> Optional[dict]:
+    """Atomically advance the chat's change sequence.
+
+    Returns the updated chat (participants, seq, last_message id); `seq` is the
+    last allocated value. Extra update operators, or pipeline stages, are
+    applied in the same write. Every allocated value must be passed to
+    commit_chat_seq once its write has finished, successfully or not; readers
+    only see sequences up to `committed_seq`.
+    """
+    if isinstance(update, list):
+        update = update + [{"$set": {"seq": {"$add": [{"$ifNull": ["$seq", 0]}, count]}}}]
+    else:
+        update = dict(update or {})
+        update["$inc"] = {**update.get("$inc", {}), "seq": count}
+    return await db.chats.find_one_and_update(
+        {"id": chat_id},
+        update,
+        projection=CHAT_SEQ_PROJECTION,
+        return_document=ReturnDocument.AFTER
+    )
+
+async def commit_chat_seq(chat_id: str, first_seq: int, last_seq: int, fields: Optional[dict] = None):
+    """Publish sequences first_seq..last_seq as finished so readers may move past them.
+
+    `committed_seq` only advances over a contiguous run of finished sequences,
+    so a change written late under a lower sequence is never skipped by a
+    client's cursor. `fields` are aggregation expressions set exactly once, in
+    the same write that marks the sequences finished: a sequence at or below
+    `committed_seq`, or in `done_seqs`, has had its fields applied.
+    """
+    # Common case: everything below is already committed, so advance in one write
+    chat = await db.chats.find_one_and_update(
+        {"id": chat_id, "committed_seq": first_seq - 1 if first_seq > 1 else {"$in": [0, None]}},
+        [{"$set": {**(fields or {}), "committed_seq": last_seq}}],
+        projection={"_id": 0, "id": 1, "done_seqs": 1}
+    )
+    if chat is not None:
+        if chat.get("done_seqs"):
+            # Later sequences finished first and were waiting for this one
+            await advance_committed_seq(chat_id)
+        return
+    await db.chats.update_one(
+        {"id": chat_id},
+        [{"$set": {
+            **(fields or {}),
+            "done_seqs": {"$setUnion": [{"$ifNull": ["$done_seqs", []]}, list(range(first_seq, last_seq + 1))]}
+        }}]
+    )
+    await advance_committed_seq(chat_id)
+
+async def advance_committed_seq(chat_id: str, force_through: Optional[int] = None):
+    """Move committed_seq over the finished sequences directly above it.
+
+    Each writer calls this after recording its own sequences, so whoever
+    finishes the lowest outstanding sequence advances past everyone waiting.
+    """
+    while True:
+        chat = await db.chats.find_one({"id": chat_id}, {"_id": 0, "committed_seq": 1, "done_seqs": 1})
+        if not chat:
+            return
+        committed = chat.get("committed_seq") or 0
+        done = set(chat.get("done_seqs") or [])
+        target = max(committed, force_through or 0)
+        while target + 1 in done:
+            target += 1
+        if target == committed:
+            if any(seq <= committed for seq in done):
+                # A late writer finished sequences that a stall repair already committed past
+                await db.chats.update_one({"id": chat_id}, {"$pull": {"done_seqs": {"$lte": committed}}})
+            return
+        await db.chats.update_one(
+            {"id": chat_id, "committed_seq": chat.get("committed_seq")},
+            {"$set": {"committed_seq": target}, "$pull": {"done_seqs": {"$lte": target}}}
+        )
+        force_through = None
+        # Loop: a conflicting advance or sequences finished meanwhile are picked up on the next read
+
+def visible_seq(chat: dict) -> int:
+    """Highest change sequence below which every change is written"""
+    return chat.get("committed_seq") or 0
+
+async def repair_stalled_seq(chat: dict):
+    """Skip sequences left uncommitted by a writer that died between allocating and committing.
+
+    Readers call this when allocations are outstanding. `seq_checkpoint`
+    records the allocated sequence at a point in time; once that is older than
+    CHAT_SEQ_STALL_TIMEOUT, every sequence up to it has had that long to commit.
+    """
+    if chat.get("seq", 0) <= visible_seq(chat):
+        return
+    now = datetime.utcnow()
+    checkpoint = chat.get("seq_checkpoint")
+    if checkpoint is not None:
+        if (now - checkpoint["at"]).total_seconds() < CHAT_SEQ_STALL_TIMEOUT:
+            return
+        if visible_seq(chat) < checkpoint["seq"]:
+            logger.warning(f"Chat {chat['id']} sequence stalled at {visible_seq(chat)}; committing through {checkpoint['seq']}")
+            await advance_committed_seq(chat["id"], force_through=checkpoint["seq"])
+    await db.chats.update_one(
+        {"id": chat["id"], "seq_checkpoint": checkpoint},
+        {"$set": {"seq_checkpoint": {"seq": chat["seq"], "at": now}}}
+    )
+
+async def backfill_committed_seq():
+    """Chats written before committed_seq existed have every allocated sequence finished"""
+    await db.chats.update_many(
+        {"committed_seq": {"$exists": False}},
+        [{"$set": {"committed_seq": {"$ifNull": ["$seq", 0]}}}]
+    )
+
+async def assign_message_seq(message: Message) -> Optional[dict]:
+    """Assign the message its sequence number.
+
+    The preview and unread counters are not touched here; commit_messages
+    applies them once the insert has succeeded.
+    """
+    chat = await allocate_chat_seq(message.chat_id)
+    if chat:
+        message.seq = message.change_seq = chat["seq"]
+    return chat
+
+async def commit_messages(chat_id: str, first_seq: int, last_seq: int, inserted: List[tuple]):
+    """Commit the sequences reserved for new messages of one chat.
+
+    `inserted` holds (Message, participants) for the messages actually stored;
+    only those move the preview, last_message_at and unread counters, so a
+    rejected insert leaves nothing behind but a skipped sequence. All of them
+    land in the single chat write that commits the sequences. The preview is
+    only replaced by a message with a higher sequence, whatever order
+    concurrent writers commit in.
+    """
+    fields = {}
+    if inserted:
+        latest = max((message for message, _ in inserted), key=lambda message: message.seq)
+        # $literal keeps message content such as "$5" from being read as a field path
+        fields["last_message"] = {"$cond": [
+            {"$lt": [{"$ifNull": ["$last_message.seq", 0]}, latest.seq]},
+            {"$literal": build_last_message_preview(latest.dict())},
+            "$last_message"
+        ]}
+        fields["last_message_at"] = {"$max": ["$last_message_at", latest.timestamp]}
+        seqs_by_recipient: Dict[str, List[int]] = {}
+        for message, participants in inserted:
+            for participant_id in participants:
+                if participant_id != message.sender_id:
+                    seqs_by_recipient.setdefault(participant_id, []).append(message.seq)
+        for participant_id, seqs in seqs_by_recipient.items():
+            # Only messages above the recipient's watermark count; one read meanwhile is not undone
+            fields[f"unread.{participant_id}"] = {"$add": [
+                {"$ifNull": [f"$unread.{participant_id}", 0]},
+                {"$size": {"$filter": {
+                    "input": seqs,
+                    "cond": {"$gt": ["$$this", {"$ifNull": [f"$read_seq.{participant_id}", 0]}]}
+                }}}
+            ]}
+    await commit_chat_seq(chat_id, first_seq, last_seq, fields)
+
+async def record_status_change(chat_id: str, message_ids: List[str], fields: dict) -> int:
+    """Apply a status change to messages of one chat under a new change sequence"""
+    chat = await allocate_chat_seq(chat_id)
+    if not chat:
+        return 0
+    try:
+        result = await db.messages.update_many(
+            {"chat_id": chat_id, "id": {"$in": message_ids}},
+            {"$set": {**fields, "change_seq": chat["seq"]}}
+        )
+    finally:
+        await commit_chat_seq(chat_id, chat["seq"], chat["seq"])
+    if "status" in fields and (chat.get("last_message") or {}).get("id") in message_ids:
+        await update_last_message_status([chat["last_message"]["id"]], fields["status"])
+    return result.modified_count
+
+async def update_last_message_status(message_ids: List[str], status_value: str):
+    """Keep the embedded preview status in sync when a message status changes"""
+    await db.chats.update_many(
+        {"last_message.id": {"$in": message_ids}},
+        {"$set": {"last_message.status": status_value}}
+    )
+
+def read_watermark(chat: dict, user_id: str) -> tuple:
+    """(read_seq, read_until) of a participant; messages at or below it count as read"""
+    return (chat.get("read_seq", {}).get(user_id, 0), chat.get("read_until", {}).get(user_id))
+
+def is_below_watermark(message: dict, watermark: tuple) -> bool:
+    read_seq, read_until = watermark
+    if message.get("seq") is not None:
+        return message["seq"] <= read_seq
+    # Messages stored before sequence numbers existed are compared by timestamp
+    return read_until is not None and message["timestamp"] <= read_until
+
+def apply_read_state(messages: List[dict], chat: dict):
+    """Derive read status from the chat's per-participant read watermarks"""
+    participants = chat.get("participants", [])
+    for message in messages:
+        if any(
+            is_below_watermark(message, read_watermark(chat, p))
+            for p in participants if p != message["sender_id"]
+        ):
+            message["is_read"] = True
+            message["status"] = "read"
+    return messages
+
+def unread_query(chat_id: str, user_id: str, read_seq: int, read_until: Optional[datetime]) -> dict:
+    """Messages of a chat that are unread for `user_id` given its watermark"""
+    legacy_unread = {"seq": None, "is_read": {"$ne": True}}
+    if read_until is not None:
+        legacy_unread["timestamp"] = {"$gt": read_until}
+    return {
+        "chat_id": chat_id,
+        "sender_id": {"$ne": user_id},
+        "$or": [{"seq": {"$gt": read_seq}}, legacy_unread]
+    }
+
+def unread_decrement_pipeline(message: dict, recipient_ids: List[str]) -> list:
+    """Update pipeline taking a deleted message out of the unread counters of recipients it is unread for"""
+    fields = {}
+    for recipient_id in recipient_ids:
+        if message.get("seq") is not None:
+            unread = {"$lt": [{"$ifNull": [f"$read_seq.{recipient_id}", 0]}, message["seq"]]}
+        elif not message.get("is_read"):
+            # A missing read_until compares below any timestamp
+            unread = {"$lt": [f"$read_until.{recipient_id}", message["timestamp"]]}
+        else:
+            continue
+        counter = {"$ifNull": [f"$unread.{recipient_id}", 0]}
+        fields[f"unread.{recipient_id}"] = {"$cond": [unread, {"$max": [0, {"$subtract": [counter, 1]}]}, counter]}
+    return [{"$set": fields}] if fields else []
+
+async def advance_read_watermark(
+    chat_id: str,
+    user_id: str,
+    seq: Optional[int],
+    timestamp: datetime,
+    message_id: Optional[str] = None
+) -> Optional[dict]:
+    """Move a participant's read watermark forward; the number of writes does not grow with the messages read.
+
+    Only messages still marked sent (never acknowledged as delivered) are
+    rewritten, as delivered, so they drop out of the offline inbox.
+
+    `message_id` is the message read up to, or None when the whole chat was
+    read. The participant's unread counter drops by the counted messages the
+    move covers. Returns the chat as it was before the move, or None when the
+    watermark was already at or past the target, in which case nothing is
+    written.
+    """
+    seq_field = f"read_seq.{user_id}"
+    until_field = f"read_until.{user_id}"
+    if seq is not None:
+        moves_forward = [{seq_field: {"$lt": seq}}, {seq_field: {"$exists": False}}]
+    else:
+        moves_forward = [{until_field: {"$lt": timestamp}}, {until_field: {"$exists": False}}]
+    update = {"$max": {until_field: timestamp}, "$inc": {"seq": 1}}
+    if seq is not None:
+        update["$max"][seq_field] = seq
+    chat = await db.chats.find_one_and_update(
+        {"id": chat_id, "participants": user_id, "$or": moves_forward},
+        update,
+        projection={"_id": 0, "id": 1, "seq": 1, "committed_seq": 1, "done_seqs": 1, seq_field: 1, until_field: 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    if not chat:
+        return None
+    own_seq = chat.get("seq", 0) + 1
+    try:
+        # Read implies delivered: messages never acknowledged as delivered leave the offline inbox
+        covered_rows = [{"seq": None, "timestamp": {"$lte": timestamp}}]
+        if seq is not None:
+            covered_rows.append({"seq": {"$lte": seq}})
+        await db.messages.update_many(
+            {"recipient_ids": user_id, "status": "sent", "chat_id": chat_id, "$or": covered_rows},
+            {"$set": {"status": "delivered", "delivered_at": datetime.utcnow(), "change_seq": own_seq}}
+        )
+    finally:
+        await commit_chat_seq(chat_id, own_seq, own_seq)
+    
+    # A message's unread increment lands when its sequence is committed, and skips
+    # recipients already past it. So exactly the covered messages committed before
+    # the move were counted; the ones committing later see the new watermark.
+    old_seq, old_until = read_watermark(chat, user_id)
+    covered = []
+    if seq is not None and seq > old_seq:
+        covered.append({"seq": {"$gt": old_seq, "$lte": min(seq, visible_seq(chat))}})
+        if chat.get("done_seqs"):
+            covered.append({"seq": {"$gt": old_seq, "$lte": seq, "$in": chat["done_seqs"]}})
+    # Messages stored before sequence numbers existed are covered by timestamp
+    legacy = {"seq": None, "is_read": {"$ne": True}, "timestamp": {"$lte": timestamp}}
+    if old_until is not None:
+        legacy["timestamp"]["$gt"] = old_until
+    covered.append(legacy)
+    read_count = await db.messages.count_documents(
+        {"chat_id": chat_id, "sender_id": {"$ne": user_id}, "$or": covered}
+    )
+    if read_count:
+        await db.chats.update_one({"id": chat_id}, {"$inc": {f"unread.{user_id}": -read_count}})
+    return chat
+
+async def rebuild_unread_counters(chat_query: dict) -> int:
+    """Consistency repair: recompute unread counters from the messages collection"""
+    rebuilt = 0
+    projection = {"_id": 0, "id": 1, "participants": 1, "read_seq": 1, "read_until": 1}
+    async for chat in db.chats.find(chat_query, projection):
+        counts = {}
+        for participant_id in chat["participants"]:
+            counts[f"unread.{participant_id}"] = await db.messages.count_documents(
+                unread_query(chat["id"], participant_id, *read_watermark(chat, participant_id))
+            )
+        # Re-check the query so a rebuild never overwrites a chat that changed to no longer match
+        await db.chats.update_one({**chat_query, "id": chat["id"]}, {"$set": counts})
+        rebuilt += 1
+    return rebuilt
+
+async def backfill_unread_counters():
+    """Chats written before unread counters existed never had their messages counted.
+    Unread decrements assume every unread message was counted, so these are rebuilt
+    before any request can touch the counters."""
+    rebuilt = await rebuild_unread_counters({"unread": {"$exists": False}})
+    if rebuilt:
+        logger.info(f"Backfilled unread counters of {rebuilt} chats")
+
+async def refresh_last_message(chat_id: str, deleted_message_id: str):
+    """Recompute the chat preview after its latest message was deleted"""
+    latest = await db.messages.find_one({"chat_id": chat_id}, {"_id": 0}, sort=[("timestamp", -1)])
+    update = (
+        {"$set": {"last_message": build_last_message_preview(latest)}}
+        if latest else {"$unset": {"last_message": ""}}
+    )
+    await db.chats.update_one({"id": chat_id, "last_message.id": deleted_message_id}, update)
+
+async def get_chat_participants(chat_id: str) -> Optional[frozenset]:
+    """Participants of a chat from the membership cache, loading it on a miss"""
+    participants = membership_cache.get(chat_id)
+    if participants is None:
+        chat = await db.chats.find_one({"id": chat_id}, {"_id": 0, "participants": 1})
+        if not chat:
+            return None
+        participants = frozenset(chat["participants"])
+        membership_cache.set(chat_id, participants)
+    return participants
+
+def client_message_key(sender_id: str, client_msg_id: str) -> str:
+    return f"{sender_id}:{client_msg_id}"
+
+def find_client_message(sender_id: str, client_msg_id: str) -> Optional[tuple]:
+    """A message recently submitted under this client_msg_id, as (Message, persistence future or None).
+
+    Only the in-memory seen-set is consulted, so a first send costs no read.
+    A retry that is no longer in it reaches the insert, where the unique
+    (sender_id, client_msg_id) index rejects it and the stored copy is returned.
+    """
+    return recent_client_messages.get(client_message_key(sender_id, client_msg_id))
+
+async def is_chat_participant(chat_id: str, user_id: str) -> bool:
+    participants = await get_chat_participants(chat_id)
+    return participants is not None and user_id in participants
+
 # Chat routes
 @api_router.get("/chats")
 async def get_chats(current_user: UserResponse = Depends(get_current_user)):
-    chats = await db.chats.find({"participants": current_user.id}).to_list(1000)
+    chats = await db.chats.find({"participants": current_user.id}, {"_id": 0}).to_list(1000)
+    
+    # Resolve every other participant and every last message in one query each
+    other_user_ids = {
+        p for chat in chats for p in chat["participants"] if p != current_user.id
+    }
+    # Chats created before the embedded preview existed fall back to the aggregation
+    chats_without_preview = [chat["id"] for chat in chats if "last_message" not in chat]
+    users_by_id, last_messages = await asyncio.gather(
+        fetch_users_by_id(list(other_user_ids)),
+        fetch_last_messages(chats_without_preview)
+    )
+    if last_messages:
+        # Backfill so the next load of these chats skips the messages collection
+        await db.chats.bulk_write([
+            UpdateOne({"id": chat_id, "last_message": {"$exists": False}},
+                      {"$set": {"last_message": build_last_message_preview(message)}})
+            for chat_id, message in last_messages.items()
+        ], ordered=False)
     
     # Populate chat info
     for chat in chats:
-        # Remove MongoDB ObjectId
-        if "_id" in chat:
-            del chat["_id"]
-            
         # Get other participants
         other_participants = [p for p in chat["participants"] if p != current_user.id]
         if other_participants:
-            other_user = await db.users.find_one({"id": other_participants[0]})
+            other_user = users_by_id.get(other_participants[0])
             if other_user:
-                # Format last seen time with Gregorian calendar
-                last_seen_text = "منذ فترة"
-                if other_user.get("is_online"):
-                    last_seen_text = "متصل"
-                elif other_user.get("last_seen"):
-                    try:
-                        last_seen = other_user["last_seen"]
-                        if isinstance(last_seen, str):
-                            # Parse ISO format datetime string
-                            last_seen = datetime.fromisoformat(last_seen.replace('Z', '+00:00'))
-                        elif not isinstance(last_seen, datetime):
-                            # If it's not a datetime object, convert it
-                            last_seen = datetime.fromisoformat(str(last_seen))
-                        
-                        now = datetime.utcnow()
-                        diff = now - last_seen
-                        
-                        if diff.days > 30:
-                            # Use Gregorian date format for older dates
-                            last_seen_text = f"آخر ظهور في {last_seen.strftime('%d %B %Y')}"
-                        elif diff.days > 7:
-                            last_seen_text = f"منذ {diff.days} يوم"
-                        elif diff.days > 0:
-                            last_seen_text = f"منذ {diff.days} يوم"
-                        elif diff.seconds > 3600:
-                            hours = diff.seconds // 3600
-                            last_seen_text = f"منذ {hours} ساعة"
-                        elif diff.seconds > 60:
-                            minutes = diff.seconds // 60
-                            last_seen_text = f"منذ {minutes} دقيقة"
-                        else:
-                            last_seen_text = "منذ قليل"
-                    except Exception as e:
-                        print(f"Error parsing last_seen: {e}")
-                        last_seen_text = "منذ فترة"
-                
+                other_user = presence.overlay(other_user)
                 chat["other_user"] = {
                     "id": other_user["id"],
                     "username": other_user["username"],
                     "is_online": other_user.get("is_online", False),
                     "last_seen": other_user.get("last_seen"),
-                    "last_seen_text": last_seen_text,
+                    "last_seen_text": format_last_seen(other_user),
                     "avatar_url": other_user.get("avatar_url")
                 }
         
-        # Get last message
-        last_message = await db.messages.find_one(
-            {"chat_id": chat["id"]},
-            sort=[("timestamp", -1)]
-        )
-        if last_message:
-            # Remove MongoDB ObjectId from message
-            if "_id" in last_message:
-                del last_message["_id"]
-            chat["last_message"] = last_message
+        if chat["id"] in last_messages:
+            chat["last_message"] = build_last_message_preview(last_messages[chat["id"]])
+        if chat.get("last_message"):
+            apply_read_state([chat["last_message"]], chat)
+        chat["unread_count"] = max(0, chat.pop("unread", {}).get(current_user.id, 0))
     
     return chats
 
@@ -504,37 +2034,183 @@ async def create_chat(other_user_id: str, current_user: UserResponse = Depends(g
     # Create new chat
     chat = Chat(participants=[current_user.id, other_user_id])
     await db.chats.insert_one(chat.dict())
+    membership_cache.set(chat.id, frozenset(chat.participants))
     return chat.dict()
 
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_PAGE_SIZE_MAX = 200
+
 @api_router.get("/chats/{chat_id}/messages")
-async def get_messages(chat_id: str, current_user: UserResponse = Depends(get_current_user)):
+async def get_messages(
+    chat_id: str,
+    response: Response,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(MESSAGES_PAGE_SIZE, ge=1, le=MESSAGES_PAGE_SIZE_MAX),
+    current_user: UserResponse = Depends(get_current_user)
+):
+    """صفحة من الرسائل بترتيب زمني تصاعدي.
+
+    Keyset pagination over (timestamp, id): without a cursor the latest page is
+    returned, `before`/`after` take a message id and return the page immediately
+    older/newer than it. `X-Has-More` tells whether another page exists in that
+    direction.
+    """
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    
     # Verify user is participant
-    chat = await db.chats.find_one({"id": chat_id, "participants": current_user.id})
+    if not await is_chat_participant(chat_id, current_user.id):
+        raise HTTPException(status_code=404, detail="Chat not found")
+    # Read state and sequence are read before the page so no change can be skipped
+    chat = await db.chats.find_one({"id": chat_id}, SYNC_CHAT_PROJECTION)
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     
-    messages = await db.messages.find({"chat_id": chat_id}).sort("timestamp", 1).to_list(1000)
+    query = {"chat_id": chat_id}
+    cursor_id = before or after
+    if cursor_id:
+        cursor_message = await db.messages.find_one({"id": cursor_id, "chat_id": chat_id}, {"timestamp": 1, "id": 1})
+        if not cursor_message:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        op = "$lt" if before else "$gt"
+        query["$or"] = [
+            {"timestamp": {op: cursor_message["timestamp"]}},
+            {"timestamp": cursor_message["timestamp"], "id": {op: cursor_id}}
+        ]
     
-    # Remove MongoDB ObjectId from messages
-    for message in messages:
-        if "_id" in message:
-            del message["_id"]
+    # Newest-first for the latest page and `before`, oldest-first for `after`
+    direction = ASCENDING if after else DESCENDING
+    messages = await db.messages.find(query, {"_id": 0}).sort(
+        [("timestamp", direction), ("id", direction)]
+    ).to_list(limit + 1)
     
-    # Mark messages as read
-    await db.messages.update_many(
-        {"chat_id": chat_id, "sender_id": {"$ne": current_user.id}},
-        {"$set": {"is_read": True}}
+    response.headers["X-Has-More"] = "true" if len(messages) > limit else "false"
+    # Starting cursor for /changes; read before the page so no change can be skipped
+    response.headers["X-Chat-Seq"] = str(visible_seq(chat))
+    messages = messages[:limit]
+    if direction == DESCENDING:
+        messages.reverse()
+    
+    return apply_read_state(messages, chat)
+
+@api_router.post("/chats/unread/rebuild")
+async def rebuild_my_unread_counters(current_user: UserResponse = Depends(get_current_user)):
+    """إعادة حساب عدادات الرسائل غير المقروءة لمحادثات المستخدم"""
+    rebuilt = await rebuild_unread_counters({"participants": current_user.id})
+    return {"status": "success", "rebuilt_chats": rebuilt}
+
+@api_router.post("/chats/{chat_id}/read")
+async def mark_chat_as_read(chat_id: str, current_user: UserResponse = Depends(get_current_user)):
+    """تعليم كل رسائل المحادثة كمقروءة بتحريك مؤشر القراءة"""
+    chat = await db.chats.find_one({"id": chat_id, "participants": current_user.id}, {"_id": 0, "committed_seq": 1})
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    
+    # Everything up to the committed sequence is written; later messages stay unread
+    advanced = await advance_read_watermark(chat_id, current_user.id, visible_seq(chat), datetime.utcnow())
+    return {"status": "success", "advanced": advanced is not None}
+
+SYNC_LIMIT_MAX = 500
+
+SYNC_CHAT_PROJECTION = {
+    "_id": 0, "id": 1, "participants": 1, "seq": 1, "committed_seq": 1, "seq_checkpoint": 1,
+    "read_seq": 1, "read_until": 1
+}
+
+async def collect_chat_changes(chat: dict, since: int, limit: int) -> dict:
+    """Messages created or changed, and messages deleted, after change sequence `since`.
+
+    Only committed sequences are read, so a change still being written under a
+    lower sequence is never skipped. Without more pages the cursor moves to the
+    committed sequence, also past sequences that left no row (read watermarks,
+    status changes that matched nothing). Read state is not a per-message
+    change; the participants' read watermarks are returned instead so the
+    client can derive it. Nothing committed after `since` returns without a
+    query.
+    """
+    chat_id = chat["id"]
+    committed = visible_seq(chat)
+    read_state = {"read_seq": chat.get("read_seq", {}), "read_until": chat.get("read_until", {})}
+    if committed <= since:
+        return {"chat_id": chat_id, "cursor": since, "messages": [], "deleted": [], **read_state, "has_more": False}
+    query = {"chat_id": chat_id, "change_seq": {"$gt": since, "$lte": committed}}
+    messages, tombstones = await asyncio.gather(
+        db.messages.find(query, {"_id": 0}).sort("change_seq", ASCENDING).to_list(limit + 1),
+        db.message_tombstones.find(query, {"_id": 0, "id": 1, "change_seq": 1}).sort("change_seq", ASCENDING).to_list(limit + 1)
+    )
+    # Both lists hold the lowest sequences of their collection, so the merged prefix is complete
+    changes = sorted(
+        [("message", m) for m in messages] + [("deleted", t) for t in tombstones],
+        key=lambda change: change[1]["change_seq"]
     )
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    return {
+        "chat_id": chat_id,
+        "cursor": changes[-1][1]["change_seq"] if has_more else max(committed, since),
+        "messages": apply_read_state([doc for kind, doc in changes if kind == "message"], chat),
+        "deleted": [doc["id"] for kind, doc in changes if kind == "deleted"],
+        **read_state,
+        "has_more": has_more
+    }
+
+@api_router.get("/chats/{chat_id}/changes")
+async def get_chat_changes(
+    chat_id: str,
+    since: int = Query(0, ge=0),
+    limit: int = Query(200, ge=1, le=SYNC_LIMIT_MAX),
+    current_user: UserResponse = Depends(get_current_user)
+):
+    """التغييرات في محادثة واحدة منذ مؤشر التسلسل"""
+    chat = await db.chats.find_one({"id": chat_id, "participants": current_user.id}, SYNC_CHAT_PROJECTION)
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
     
-    return messages
+    await repair_stalled_seq(chat)
+    return await collect_chat_changes(chat, since, limit)
+
+@api_router.post("/sync")
+async def sync_chats(sync_data: SyncRequest, current_user: UserResponse = Depends(get_current_user)):
+    """التغييرات في كل محادثات المستخدم منذ المؤشرات المرسلة.
+
+    Only chats whose sequence moved past the client's cursor touch the messages
+    collection, so an idle poll costs a single indexed chats query.
+    """
+    limit = max(1, min(sync_data.limit, SYNC_LIMIT_MAX))
+    chats = await db.chats.find({"participants": current_user.id}, SYNC_CHAT_PROJECTION).to_list(1000)
+    await asyncio.gather(*[repair_stalled_seq(chat) for chat in chats if chat.get("seq", 0) > visible_seq(chat)])
+    changed_chats = [
+        chat for chat in chats
+        if visible_seq(chat) > sync_data.cursors.get(chat["id"], 0)
+    ]
+    results = await asyncio.gather(*[
+        collect_chat_changes(chat, sync_data.cursors.get(chat["id"], 0), limit)
+        for chat in changed_chats
+    ])
+    return {"chats": list(results)}
 
 @api_router.post("/messages")
 async def send_message(message_data: MessageCreate, current_user: UserResponse = Depends(get_current_user)):
     # Verify user is participant in the chat
-    chat = await db.chats.find_one({"id": message_data.chat_id, "participants": current_user.id})
-    if not chat:
+    participants = await get_chat_participants(message_data.chat_id)
+    if participants is None or current_user.id not in participants:
         raise HTTPException(status_code=404, detail="Chat not found")
     
+    # A retried submission returns the stored message without writing or fanning out again
+    if message_data.client_msg_id:
+        seen = find_client_message(current_user.id, message_data.client_msg_id)
+        if seen is not None:
+            existing, persisted = seen
+            try:
+                if persisted is not None:
+                    existing = await persisted
+            except Exception:
+                existing = None
+            if existing is not None:
+                return existing.dict()
+            # The original attempt was not stored; store this one
+    
     # Create message
     message = Message(
         chat_id=message_data.chat_id,
@@ -542,42 +2218,65 @@ async def send_message(message_data: MessageCreate, current_user: UserResponse =
         content=message_data.content,
         message_type=message_data.message_type,
         replied_to=message_data.replied_to,
+        client_msg_id=message_data.client_msg_id,
+        recipient_ids=[p for p in participants if p != current_user.id],
         status="sent",
         timestamp=datetime.utcnow()  # Explicitly set UTC timestamp
     )
+    # A concurrent retry waits on `persisted`: the stored message, or None when this attempt failed
+    persisted = asyncio.get_running_loop().create_future()
+    seen_key = client_message_key(message.sender_id, message.client_msg_id) if message.client_msg_id else None
+    if seen_key:
+        recent_client_messages.set(seen_key, (message, persisted))
     
-    # Save to database
-    await db.messages.insert_one(message.dict())
-    
-    # Update chat last message time
-    await db.chats.update_one(
-        {"id": message.chat_id},
-        {"$set": {"last_message_at": datetime.utcnow()}}
-    )
+    try:
+        # Allocate the message sequence; preview and unread counters follow only a stored message
+        chat = await assign_message_seq(message)
+        if not chat:
+            raise HTTPException(status_code=404, detail="Chat not found")
+        stored = False
+        try:
+            await db.messages.insert_one(message.dict())
+            stored = True
+        finally:
+            await commit_messages(message.chat_id, message.seq, message.seq, [(message, participants)] if stored else [])
+    except DuplicateKeyError:
+        # Same client_msg_id stored concurrently by another worker; the unique index keeps one copy
+        existing = await db.messages.find_one(
+            {"sender_id": current_user.id, "client_msg_id": message.client_msg_id}, {"_id": 0}
+        )
+        stored_copy = Message(**existing) if existing else None
+        if stored_copy:
+            # Later retries are answered with the stored copy rather than this rejected one
+            recent_client_messages.set(seen_key, (stored_copy, None))
+        persisted.set_result(stored_copy)
+        return existing
+    except BaseException:
+        # Let the client's retry go through
+        if seen_key:
+            recent_client_messages.invalidate(seen_key)
+        persisted.set_result(None)
+        raise
+    persisted.set_result(message)
     
     # Try to send via WebSocket to other participants (if connected)
+    event = OutboundEvent({"type": "new_message", "message": message.dict()})
     message_delivered = False
-    for participant_id in chat["participants"]:
+    for participant_id in participants:
         if participant_id != current_user.id:
-            delivered = await manager.send_personal_message({
-                "type": "new_message",
-                "message": message.dict()
-            }, participant_id)
+            delivered = manager.send_personal_message(event, participant_id)
             
             if delivered:
                 message_delivered = True
     
     # Update message status to delivered if successfully sent via WebSocket
     if message_delivered:
-        await db.messages.update_one(
-            {"id": message.id},
-            {"$set": {
-                "status": "delivered",
-                "delivered_at": datetime.utcnow()
-            }}
-        )
         message.status = "delivered"
         message.delivered_at = datetime.utcnow()
+        await record_status_change(message.chat_id, [message.id], {
+            "status": "delivered",
+            "delivered_at": message.delivered_at
+        })
     
     # Remove MongoDB ObjectId
     message_dict = message.dict()
@@ -594,31 +2293,23 @@ async def mark_message_as_read(message_id: str, current_user: UserResponse = Dep
         raise HTTPException(status_code=404, detail="Message not found")
     
     # Check if user is participant in the chat
-    chat = await db.chats.find_one({"id": message["chat_id"], "participants": current_user.id})
-    if not chat:
+    if not await is_chat_participant(message["chat_id"], current_user.id):
         raise HTTPException(status_code=403, detail="Access denied")
     
     # Don't update if it's the sender's own message
     if message["sender_id"] == current_user.id:
         return {"status": "success", "message": "Cannot mark own message as read"}
     
-    # Update message status to read
-    await db.messages.update_one(
-        {"id": message_id},
-        {"$set": {
-            "status": "read",
-            "is_read": True,
-            "read_at": datetime.utcnow()
-        }}
-    )
+    # Advance the reader's watermark up to this message
+    await advance_read_watermark(message["chat_id"], current_user.id, message.get("seq"), message["timestamp"], message_id)
     
     # Notify sender via WebSocket if connected
-    await manager.send_personal_message({
+    manager.send_personal_message({
         "type": "message_read",
         "message_id": message_id,
         "read_by": current_user.id,
         "read_at": datetime.utcnow().isoformat()
-    }, message["sender_id"])
+    }, message["sender_id"], coalesce_key=f"message_read:{message_id}")
     
     return {"status": "success"}
 
@@ -634,19 +2325,39 @@ async def delete_message(message_id: str, current_user: UserResponse = Depends(g
         if message["sender_id"] != current_user.id:
             raise HTTPException(status_code=403, detail="Can only delete your own messages")
         
-        # Delete the message
-        await db.messages.delete_one({"id": message_id})
+        # Delete the message and leave a tombstone for delta sync
+        deleted = await db.messages.delete_one({"id": message_id})
+        if not deleted.deleted_count:
+            # A concurrent request deleted it and updates the chat
+            return {"status": "success", "message": "Message deleted"}
         
-        # Notify other participants via WebSocket
-        chat = await db.chats.find_one({"id": message["chat_id"]})
+        participants = await get_chat_participants(message["chat_id"]) or frozenset()
+        recipient_ids = [p for p in participants if p != message["sender_id"]]
+        chat = await allocate_chat_seq(message["chat_id"], unread_decrement_pipeline(message, recipient_ids))
         if chat:
+            try:
+                await db.message_tombstones.insert_one({
+                    "id": message_id,
+                    "chat_id": message["chat_id"],
+                    "change_seq": chat["seq"],
+                    "deleted_at": datetime.utcnow()
+                })
+            finally:
+                await commit_chat_seq(chat["id"], chat["seq"], chat["seq"])
+            
+            # Recompute the chat preview if the deleted message was the latest one
+            if (chat.get("last_message") or {}).get("id") == message_id:
+                await refresh_last_message(chat["id"], message_id)
+            
+            # Notify other participants via WebSocket
+            event = OutboundEvent({
+                "type": "message_deleted",
+                "message_id": message_id,
+                "chat_id": message["chat_id"]
+            })
             for participant_id in chat["participants"]:
                 if participant_id != current_user.id:
-                    await manager.send_personal_message({
-                        "type": "message_deleted",
-                        "message_id": message_id,
-                        "chat_id": message["chat_id"]
-                    }, participant_id)
+                    manager.send_personal_message(event, participant_id)
         
         return {"status": "success", "message": "Message deleted"}
         
@@ -664,7 +2375,7 @@ async def get_all_users(current_user: UserResponse = Depends(get_current_user)):
             {"password_hash": 0}  # Exclude password hash
         ).to_list(100)
         
-        return users
+        return [presence.overlay(user) for user in users]
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -681,19 +2392,719 @@ async def search_users(q: str, current_user: UserResponse = Depends(get_current_
         ]
     }).to_list(10)
     
-    return [UserResponse(**user) for user in users]
+    return [UserResponse(**presence.overlay(user)) for user in users]
+
+# Write-behind persistence for WebSocket messages
+WS_WRITE_BATCH_SIZE = int(os.environ.get('WS_WRITE_BATCH_SIZE', '200'))
+WS_WRITE_BATCH_DELAY = float(os.environ.get('WS_WRITE_BATCH_DELAY', '0.005'))  # seconds
+
+class MessageWriteBatcher:
+    """Group commit for inbound WebSocket messages.
+
+    Messages submitted within WS_WRITE_BATCH_DELAY (or until WS_WRITE_BATCH_SIZE
+    accumulate) are stored with one insert_many plus one sequence/preview/unread
+    update per chat. While a batch is being written the next one fills up, so
+    batches grow with load. Each submit returns a future resolved once that
+    message is durable.
+    """
+    def __init__(self, max_batch: int, max_delay: float):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending: List[tuple] = []  # (message, participants, future)
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.stopping = False
+        self.flushes = 0
+        self.flushed_messages = 0
+
+    def submit(self, message: Message, participants: List[str]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        if self.stopping:
+            future.set_exception(RuntimeError("Server is shutting down"))
+            return future
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+        self.pending.append((message, participants, future))
+        self.wakeup.set()
+        return future
+
+    async def _run(self):
+        while True:
+            await self.wakeup.wait()
+            if len(self.pending) < self.max_batch and not self.stopping:
+                await asyncio.sleep(self.max_delay)
+            batch = self.pending[:self.max_batch]
+            del self.pending[:self.max_batch]
+            if not self.pending:
+                self.wakeup.clear()
+            if batch:
+                await self._flush(batch)
+            if self.stopping and not self.pending:
+                return
+
+    async def _flush(self, batch: List[tuple]):
+        try:
+            batch = await self._allocate(batch)
+            if batch:
+                failed = {}
+                stored: Set[int] = set()
+                try:
+                    await db.messages.insert_many([message.dict() for message, _, _ in batch], ordered=False)
+                    stored = set(range(len(batch)))
+                except BulkWriteError as e:
+                    failed = {error["index"]: error for error in e.details.get("writeErrors", [])}
+                    stored = set(range(len(batch))) - set(failed)
+                finally:
+                    await self._commit(batch, stored)
+                for index, (message, _, future) in enumerate(batch):
+                    if future.done():
+                        continue
+                    if index not in failed:
+                        future.set_result(message)
+                    elif failed[index].get("code") == 11000:
+                        # client_msg_id already stored by another worker
+                        future.set_exception(DuplicateKeyError(failed[index].get("errmsg", ""), 11000))
+                    else:
+                        future.set_exception(RuntimeError("Message could not be stored"))
+            self.flushes += 1
+            self.flushed_messages += len(batch)
+        except Exception as e:
+            logger.error(f"Message batch flush failed: {e}")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def _allocate(self, batch: List[tuple]) -> List[tuple]:
+        """One find_one_and_update per chat reserves its sequence numbers.
+
+        A chat whose allocation fails fails only its own items; the rest of
+        the batch is still written.
+        """
+        by_chat: Dict[str, List[tuple]] = {}
+        for item in batch:
+            by_chat.setdefault(item[0].chat_id, []).append(item)
+        
+        chats = await asyncio.gather(*[
+            allocate_chat_seq(chat_id, count=len(items)) for chat_id, items in by_chat.items()
+        ], return_exceptions=True)
+        allocated = []
+        for items, chat in zip(by_chat.values(), chats):
+            if chat is None or isinstance(chat, BaseException):
+                error = chat if isinstance(chat, BaseException) else RuntimeError("Chat not found")
+                for _, _, future in items:
+                    future.set_exception(error)
+                continue
+            first_seq = chat["seq"] - len(items) + 1
+            for offset, (message, _, _) in enumerate(items):
+                message.seq = message.change_seq = first_seq + offset
+            allocated.extend(items)
+        return allocated
+
+    async def _commit(self, batch: List[tuple], stored: Set[int]):
+        """Commit each chat's reserved sequence range; only stored messages update preview and unread"""
+        by_chat: Dict[str, List[tuple]] = {}
+        for index, (message, participants, _) in enumerate(batch):
+            by_chat.setdefault(message.chat_id, []).append((message, participants, index in stored))
+        results = await asyncio.gather(*[
+            commit_messages(
+                chat_id,
+                min(message.seq for message, _, _ in items),
+                max(message.seq for message, _, _ in items),
+                [(message, participants) for message, participants, ok in items if ok]
+            )
+            for chat_id, items in by_chat.items()
+        ], return_exceptions=True)
+        for chat_id, result in zip(by_chat, results):
+            if isinstance(result, Exception):
+                # The messages are stored; readers skip the range once it counts as stalled
+                logger.error(f"Committing sequences of chat {chat_id} failed: {result}")
+
+    async def stop(self):
+        """Refuse new messages, then let the loop finish the batch in flight and drain the rest"""
+        self.stopping = True
+        if self.task is not None:
+            self.wakeup.set()
+            await self.task
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "flushes": self.flushes,
+            "flushed_messages": self.flushed_messages,
+            "average_batch": round(self.flushed_messages / self.flushes, 2) if self.flushes else 0.0
+        }
+
+message_writer = MessageWriteBatcher(WS_WRITE_BATCH_SIZE, WS_WRITE_BATCH_DELAY)
+
+async def complete_ws_send(connection_id: str, user_id: str, message: Message, participants: List[str], persisted: asyncio.Future):
+    """Fan out and acknowledge a WebSocket message once its batch is durable"""
+    try:
+        await persisted
+    except DuplicateKeyError:
+        existing = await db.messages.find_one(
+            {"sender_id": user_id, "client_msg_id": message.client_msg_id}, {"_id": 0}
+        )
+        if existing:
+            # Later retries are answered with the stored copy rather than this rejected one
+            recent_client_messages.set(client_message_key(user_id, message.client_msg_id), (Message(**existing), None))
+        manager.send_to_connection(connection_id, {"type": "message_sent", "message": existing})
+        return
+    except Exception as e:
+        if message.client_msg_id:
+            # Let the client's retry go through
+            recent_client_messages.invalidate(client_message_key(user_id, message.client_msg_id))
+        manager.send_to_connection(connection_id, {
+            "type": "error",
+            "detail": str(e),
+            "chat_id": message.chat_id,
+            "message_id": message.id
+        })
+        return
+    
+    # Send to all participants, serialized once
+    event = OutboundEvent({"type": "new_message", "message": message.dict()})
+    message_delivered = False
+    for participant_id in participants:
+        if participant_id != user_id:
+            if manager.send_personal_message(event, participant_id):
+                message_delivered = True
+    
+    # Update message status to delivered if a recipient is connected, as the REST path does
+    if message_delivered:
+        message.status = "delivered"
+        message.delivered_at = datetime.utcnow()
+        try:
+            await record_status_change(message.chat_id, [message.id], {
+                "status": "delivered",
+                "delivered_at": message.delivered_at
+            })
+        except Exception as e:
+            # The message is stored and fanned out; the sender still gets its ack
+            logger.error(f"Marking message {message.id} delivered failed: {e}")
+    
+    # Confirm message sent (queued behind earlier events for this socket)
+    manager.send_to_connection(connection_id, {
+        "type": "message_sent",
+        "message": message.dict()
+    })
+
+OFFLINE_INBOX_BATCH_SIZE = int(os.environ.get('OFFLINE_INBOX_BATCH_SIZE', '500'))
+OFFLINE_INBOX_MAX_BATCHES = int(os.environ.get('OFFLINE_INBOX_MAX_BATCHES', '10'))
+
+def build_receipts_event(status_value: str, reader_id: str, message_ids_by_chat: Dict[str, List[str]]) -> OutboundEvent:
+    """One coalesced delivery/read receipt for all the messages of a sender"""
+    return OutboundEvent({
+        "type": "receipts",
+        "status": status_value,
+        "by": reader_id,
+        "at": datetime.utcnow().isoformat(),
+        "chats": message_ids_by_chat
+    })
+
+async def mark_delivered(messages: List[dict], recipient_id: str):
+    """Flip messages to delivered in one bulk write and send each sender a single receipt"""
+    delivered_at = datetime.utcnow()
+    ids_by_chat: Dict[str, List[str]] = {}
+    for message in messages:
+        ids_by_chat.setdefault(message["chat_id"], []).append(message["id"])
+    
+    # One change sequence per chat so delta sync sees the new status
+    chats = await asyncio.gather(*[allocate_chat_seq(chat_id) for chat_id in ids_by_chat])
+    updates = [
+        UpdateMany(
+            {"chat_id": chat["id"], "id": {"$in": ids_by_chat[chat["id"]]}, "status": "sent"},
+            {"$set": {"status": "delivered", "delivered_at": delivered_at, "change_seq": chat["seq"]}}
+        )
+        for chat in chats if chat
+    ]
+    if not updates:
+        return 0
+    try:
+        result = await db.messages.bulk_write(updates, ordered=False)
+    finally:
+        await asyncio.gather(*[commit_chat_seq(chat["id"], chat["seq"], chat["seq"]) for chat in chats if chat])
+    await update_last_message_status([m["id"] for m in messages], "delivered")
+    
+    receipts_by_sender: Dict[str, Dict[str, List[str]]] = {}
+    for message in messages:
+        receipts_by_sender.setdefault(message["sender_id"], {}).setdefault(message["chat_id"], []).append(message["id"])
+    for sender_id, message_ids_by_chat in receipts_by_sender.items():
+        manager.send_personal_message(build_receipts_event("delivered", recipient_id, message_ids_by_chat), sender_id)
+    return result.modified_count
+
+RECEIPT_MESSAGE_PROJECTION = {"_id": 0, "id": 1, "chat_id": 1, "sender_id": 1, "seq": 1, "timestamp": 1}
+ACK_MAX_MESSAGES = int(os.environ.get('ACK_MAX_MESSAGES', '1000'))
+
+async def apply_receipts(reader_id: str, status_value: str, messages: List[dict]) -> int:
+    """Apply delivered/read receipts from `reader_id`.
+
+    Messages of chats the reader is not part of are ignored. Delivery is one
+    bulk write for all chats; reading moves the reader's watermark once per
+    chat. Every sender gets a single coalesced receipts event.
+    """
+    messages_by_chat: Dict[str, List[dict]] = {}
+    for message in messages:
+        if message["sender_id"] != reader_id:
+            messages_by_chat.setdefault(message["chat_id"], []).append(message)
+    for chat_id in list(messages_by_chat):
+        if not await is_chat_participant(chat_id, reader_id):
+            del messages_by_chat[chat_id]
+    if not messages_by_chat:
+        return 0
+    
+    if status_value == "delivered":
+        return await mark_delivered([m for chat_messages in messages_by_chat.values() for m in chat_messages], reader_id)
+    
+    async def advance(chat_id: str, chat_messages: List[dict]) -> List[dict]:
+        newest = max(chat_messages, key=lambda m: (m.get("seq") or 0, m["timestamp"]))
+        advanced = await advance_read_watermark(chat_id, reader_id, newest.get("seq"), newest["timestamp"], newest["id"])
+        return chat_messages if advanced else []
+    
+    read_messages = [
+        m for chat_messages in await asyncio.gather(*[advance(c, ms) for c, ms in messages_by_chat.items()])
+        for m in chat_messages
+    ]
+    receipts_by_sender: Dict[str, Dict[str, List[str]]] = {}
+    for message in read_messages:
+        receipts_by_sender.setdefault(message["sender_id"], {}).setdefault(message["chat_id"], []).append(message["id"])
+    for sender_id, message_ids_by_chat in receipts_by_sender.items():
+        manager.send_personal_message(build_receipts_event("read", reader_id, message_ids_by_chat), sender_id)
+    return len(read_messages)
+
+def parse_ack_frame(frame: dict) -> Optional[tuple]:
+    """Validate an `ack` frame: {"status": "delivered"|"read", "chat_id", "message_ids": [...], "ranges": [[from_seq, to_seq], ...]}
+
+    Returns (status, chat_id, selectors), or None when the frame is malformed.
+    """
+    status_value = frame.get("status")
+    chat_id = frame.get("chat_id")
+    message_ids = frame.get("message_ids") or []
+    ranges = frame.get("ranges") or []
+    if status_value not in ("delivered", "read") or not isinstance(chat_id, str) or not chat_id:
+        return None
+    if not isinstance(message_ids, list) or not all(isinstance(message_id, str) for message_id in message_ids):
+        return None
+    if not isinstance(ranges, list):
+        return None
+    selectors = []
+    if message_ids:
+        selectors.append({"id": {"$in": message_ids[:ACK_MAX_MESSAGES]}})
+    for seq_range in ranges[:ACK_MAX_MESSAGES]:
+        if (
+            not isinstance(seq_range, list) or len(seq_range) != 2
+            or not all(isinstance(seq, int) and not isinstance(seq, bool) for seq in seq_range)
+            or seq_range[0] > seq_range[1]
+        ):
+            return None
+        selectors.append({"seq": {"$gte": seq_range[0], "$lte": seq_range[1]}})
+    if not selectors:
+        return None
+    return status_value, chat_id, selectors
+
+async def handle_ack_frame(connection_id: str, user_id: str, status_value: str, chat_id: str, selectors: List[dict]):
+    """Apply a validated `ack` frame; failures are reported to the connection as an error frame"""
+    try:
+        if not await is_chat_participant(chat_id, user_id):
+            manager.send_to_connection(connection_id, {"type": "error", "detail": "Chat not found", "chat_id": chat_id})
+            return
+        
+        query = {"chat_id": chat_id, "sender_id": {"$ne": user_id}, "$or": selectors}
+        if status_value == "delivered":
+            query["status"] = "sent"
+        # Newest first so a read ack always reaches the newest acknowledged message
+        messages = await db.messages.find(query, RECEIPT_MESSAGE_PROJECTION).sort(
+            [("timestamp", DESCENDING), ("id", DESCENDING)]
+        ).to_list(ACK_MAX_MESSAGES)
+        await apply_receipts(user_id, status_value, messages)
+    except Exception as e:
+        logger.error(f"Ack from {user_id} failed: {e}")
+        manager.send_to_connection(connection_id, {"type": "error", "detail": "Ack failed", "chat_id": chat_id})
+
+async def deliver_offline_inbox(connection_id: str, user_id: str):
+    """Push messages still marked sent to a freshly connected user.
+
+    Queuing a frame does not mean the client got it, so nothing it carries is
+    marked here: the client confirms with an `ack` frame (or POST
+    /messages/update-status) and that flips the messages to delivered.
+    Messages already below the user's read watermark were seen; they are
+    marked delivered instead of being pushed again.
+    """
+    try:
+        chats = await db.chats.find(
+            {"participants": user_id},
+            {"_id": 0, "id": 1, f"read_seq.{user_id}": 1, f"read_until.{user_id}": 1}
+        ).to_list(None)
+        watermarks = {chat["id"]: read_watermark(chat, user_id) for chat in chats}
+        query = {"recipient_ids": user_id, "status": "sent"}
+        for _ in range(OFFLINE_INBOX_MAX_BATCHES):
+            messages = await db.messages.find(query, {"_id": 0, "recipient_ids": 0}).sort(
+                [("timestamp", ASCENDING), ("id", ASCENDING)]
+            ).to_list(OFFLINE_INBOX_BATCH_SIZE)
+            if not messages:
+                return
+            already_read = {
+                m["id"] for m in messages
+                if is_below_watermark(m, watermarks.get(m["chat_id"], (0, None)))
+            }
+            if already_read:
+                await db.messages.update_many(
+                    {"id": {"$in": list(already_read)}, "status": "sent"},
+                    {"$set": {"status": "delivered", "delivered_at": datetime.utcnow()}}
+                )
+            pending = [m for m in messages if m["id"] not in already_read]
+            if pending and not manager.send_to_connection(connection_id, {"type": "pending_messages", "messages": pending}):
+                return
+            if len(messages) < OFFLINE_INBOX_BATCH_SIZE:
+                return
+            # Continue after the last pushed message; acks may not have arrived yet
+            last = messages[-1]
+            query = {"recipient_ids": user_id, "status": "sent", "$or": [
+                {"timestamp": {"$gt": last["timestamp"]}},
+                {"timestamp": last["timestamp"], "id": {"$gt": last["id"]}}
+            ]}
+    except Exception as e:
+        logger.error(f"Offline inbox delivery failed for {user_id}: {e}")
+
+async def ack_duplicate_ws_send(connection_id: str, seen: tuple):
+    """Acknowledge a retried WebSocket message with the original once it is durable"""
+    existing, persisted = seen
+    if persisted is not None:
+        try:
+            existing = await persisted
+        except Exception:
+            existing = None
+        if existing is None:
+            # The original attempt reports its own failure
+            return
+    manager.send_to_connection(connection_id, {"type": "message_sent", "message": existing.dict()})
 
 # WebSocket endpoint
+# Inbound frame rate limiting, as "tokens per second/burst"
+WS_RATE_LIMITS = {
+    # kind: (per-connection limit, per-user limit across all of the user's connections)
+    "message": (os.environ.get('WS_RATE_MESSAGE', '5/20'), os.environ.get('WS_USER_RATE_MESSAGE', '10/40')),
+    "receipt": (os.environ.get('WS_RATE_RECEIPT', '10/40'), os.environ.get('WS_USER_RATE_RECEIPT', '20/80')),
+    "typing": (os.environ.get('WS_RATE_TYPING', '5/10'), os.environ.get('WS_USER_RATE_TYPING', '10/20')),
+}
+WS_RATE_LIMIT_USERS = int(os.environ.get('WS_RATE_LIMIT_USERS', '100000'))
+
+def parse_rate(value: str) -> tuple:
+    rate, _, burst = value.partition("/")
+    return float(rate), float(burst or rate)
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, rate: float, burst: float, now: float) -> float:
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        return self.tokens
+
+class FrameRateLimiter:
+    """Token buckets for inbound WebSocket frames, one budget per frame kind.
+
+    A frame needs a token from its connection's bucket and from the user's
+    bucket, so extra tabs do not multiply a client's budget. Buckets are two
+    floats with __slots__ and only exist for kinds a client actually sends.
+    """
+    def __init__(self, limits: Dict[str, tuple], max_users: int):
+        self.kinds = list(limits)
+        self.limits = [(parse_rate(connection), parse_rate(user)) for connection, user in limits.values()]
+        self.user_buckets = LRUCache(max_users)  # user_id -> list of TokenBucket per kind
+        self.allowed = [0] * len(self.kinds)
+        self.rejected = [0] * len(self.kinds)
+
+    def _buckets(self, buckets: Optional[list], index: int, burst: float, now: float) -> list:
+        if buckets is None:
+            buckets = [None] * len(self.kinds)
+        if buckets[index] is None:
+            buckets[index] = TokenBucket(burst, now)
+        return buckets
+
+    def check(self, connection: ClientConnection, kind: str) -> float:
+        """Take a token for one frame; returns 0 if allowed, otherwise seconds until it would be"""
+        index = self.kinds.index(kind)
+        (connection_rate, connection_burst), (user_rate, user_burst) = self.limits[index]
+        now = time.monotonic()
+        connection.rate_buckets = self._buckets(connection.rate_buckets, index, connection_burst, now)
+        user_buckets = self._buckets(self.user_buckets.get(connection.user_id), index, user_burst, now)
+        self.user_buckets.set(connection.user_id, user_buckets)
+        
+        connection_bucket = connection.rate_buckets[index]
+        user_bucket = user_buckets[index]
+        connection_tokens = connection_bucket.refill(connection_rate, connection_burst, now)
+        user_tokens = user_bucket.refill(user_rate, user_burst, now)
+        if connection_tokens >= 1 and user_tokens >= 1:
+            connection_bucket.tokens -= 1
+            user_bucket.tokens -= 1
+            self.allowed[index] += 1
+            return 0.0
+        self.rejected[index] += 1
+        return max((1 - connection_tokens) / connection_rate, (1 - user_tokens) / user_rate)
+
+    def stats(self) -> dict:
+        stats = {"tracked_users": self.user_buckets.stats()["size"]}
+        for index, kind in enumerate(self.kinds):
+            stats[kind] = {
+                "connection_limit": "%g/%g" % self.limits[index][0],
+                "user_limit": "%g/%g" % self.limits[index][1],
+                "allowed": self.allowed[index],
+                "rejected": self.rejected[index]
+            }
+        return stats
+
+frame_limiter = FrameRateLimiter(WS_RATE_LIMITS, WS_RATE_LIMIT_USERS)
+
+def reject_rate_limited(connection_id: str, frame: dict, retry_after: float):
+    manager.send_to_connection(connection_id, {
+        "type": "error",
+        "detail": "Rate limit exceeded",
+        "frame": frame.get("type"),
+        "chat_id": frame.get("chat_id"),
+        "client_msg_id": frame.get("client_msg_id"),
+        "retry_after": round(retry_after, 3)
+    })
+
+# Typing indicators
+TYPING_INTERVAL = float(os.environ.get('TYPING_INTERVAL', '2'))  # seconds between fanned-out transitions per (user, chat)
+TYPING_TIMEOUT = float(os.environ.get('TYPING_TIMEOUT', '5'))  # a start with no further input expires after this
+
+class TypingState:
+    __slots__ = ("recipients", "wanted", "announced", "last_input", "last_transition", "timer", "deadline")
+
+    def __init__(self, recipients: List[str]):
+        self.recipients = recipients
+        self.wanted = False
+        self.announced = False
+        self.last_input = 0.0
+        self.last_transition = float("-inf")
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.deadline = 0.0
+
+class TypingTracker:
+    """Typing indicators, throttled and coalesced in memory without touching Mongo.
+
+    Clients report typing per keystroke. For each (user, chat) only the latest
+    wanted state is kept and at most one start/stop transition per
+    TYPING_INTERVAL is fanned out; a start with no input for TYPING_TIMEOUT
+    turns into a stop. Typing events are transient and skip the replay buffer.
+    """
+    def __init__(self, interval: float, timeout: float):
+        self.interval = interval
+        self.timeout = timeout
+        self.states: Dict[tuple, TypingState] = {}  # (user_id, chat_id) -> TypingState
+        self.received = 0
+        self.transitions = 0
+
+    def update(self, user_id: str, chat_id: str, recipients: List[str], is_typing: bool):
+        self.received += 1
+        key = (user_id, chat_id)
+        state = self.states.get(key)
+        if state is None:
+            if not is_typing:
+                # Nothing was announced, so there is nothing to stop
+                return
+            state = self.states[key] = TypingState(recipients)
+        now = time.monotonic()
+        state.wanted = is_typing
+        if is_typing:
+            state.last_input = now
+        self._reconcile(key, state, now)
+
+    def _reconcile(self, key: tuple, state: TypingState, now: float):
+        if state.wanted and now - state.last_input >= self.timeout:
+            state.wanted = False
+        if state.wanted != state.announced:
+            next_transition = state.last_transition + self.interval
+            if now < next_transition:
+                self._schedule(key, state, next_transition)
+                return
+            state.announced = state.wanted
+            state.last_transition = now
+            self._fan_out(key, state)
+        if state.announced:
+            self._schedule(key, state, state.last_input + self.timeout)
+        elif now < state.last_transition + self.interval:
+            # Keep the state until the interval ends so a quick restart is still throttled
+            self._schedule(key, state, state.last_transition + self.interval)
+        else:
+            if state.timer is not None:
+                state.timer.cancel()
+            del self.states[key]
+
+    def _schedule(self, key: tuple, state: TypingState, deadline: float):
+        if state.timer is not None:
+            if state.deadline <= deadline:
+                # The earlier check reconciles again and schedules the later one
+                return
+            state.timer.cancel()
+        state.deadline = deadline
+        state.timer = asyncio.get_running_loop().call_later(
+            max(deadline - time.monotonic(), 0), self._fire, key
+        )
+
+    def _fire(self, key: tuple):
+        state = self.states.get(key)
+        if state is None:
+            return
+        state.timer = None
+        self._reconcile(key, state, time.monotonic())
+
+    def _fan_out(self, key: tuple, state: TypingState):
+        user_id, chat_id = key
+        event = OutboundEvent({"type": "typing", "chat_id": chat_id, "user_id": user_id, "is_typing": state.announced})
+        for recipient_id in state.recipients:
+            manager.send_personal_message(event, recipient_id, coalesce_key=f"typing:{chat_id}:{user_id}", transient=True)
+        self.transitions += 1
+
+    def stats(self) -> dict:
+        return {
+            "tracked": len(self.states),
+            "typing": sum(1 for state in self.states.values() if state.announced),
+            "received": self.received,
+            "transitions": self.transitions
+        }
+
+typing_tracker = TypingTracker(TYPING_INTERVAL, TYPING_TIMEOUT)
+
+def parse_last_event_id(value: Optional[str]):
+    """Split an "<epoch>:<seq>" event id into (epoch, seq); (None, None) if it is not one"""
+    if not value:
+        return None, None
+    epoch, _, seq = value.partition(":")
+    if not epoch or not seq.isdigit():
+        return None, None
+    return epoch, int(seq)
+
+@api_router.get("/events")
+async def event_stream(
+    token: Optional[str] = None,
+    last_seq: Optional[int] = None,
+    epoch: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None),
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+):
+    """Server-Sent Events fallback for clients without a WebSocket.
+
+    Streams the same events as /ws/{user_id}. A reconnecting EventSource sends
+    Last-Event-ID and resumes from the replay buffer; `last_seq` and `epoch`
+    let a client continue a WebSocket session over the stream.
+    """
+    if credentials is not None:
+        token = credentials.credentials
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    current_user = await authenticate_token(token)
+    
+    resume_epoch, resume_seq = parse_last_event_id(last_event_id)
+    if resume_seq is not None:
+        epoch, last_seq = resume_epoch, resume_seq
+    connection = EventStreamConnection(str(uuid.uuid4()), current_user.id, manager)
+    manager.register(connection, last_seq, epoch)
+    
+    return StreamingResponse(
+        connection.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def authenticate_websocket(websocket: WebSocket, token: Optional[str]) -> Optional[UserResponse]:
+    """Principal of a WebSocket handshake from an Authorization: Bearer header or the `token` query parameter"""
+    authorization = websocket.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        token = authorization[len("bearer "):]
+    if not token:
+        return None
+    try:
+        return await authenticate_token(token)
+    except HTTPException:
+        return None
+
 @app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    connection_id = await manager.connect(websocket, user_id)
+async def websocket_endpoint(
+    websocket: WebSocket,
+    user_id: str,
+    token: Optional[str] = None,
+    last_seq: Optional[int] = None,
+    epoch: Optional[str] = None
+):
+    """Pass `last_seq` and `epoch` from the previous session to resume without refetching.
+
+    The access token from /auth/login goes in `token` (browsers cannot set
+    headers on a WebSocket) or an Authorization: Bearer header, and must
+    belong to `user_id`; otherwise the handshake is refused with 1008 before
+    anything is replayed or pushed.
+    The server sends {"type": "ping"} after WS_PING_INTERVAL without inbound
+    frames; a client that sends nothing (not even a pong) for another
+    WS_PING_TIMEOUT is reaped. Clients may send {"type": "ping"} to get a pong.
+    Typing is reported with {"type": "typing", "chat_id": ..., "is_typing": bool}.
+    Offering the "msgpack" subprotocol switches both directions to MessagePack
+    binary frames with the same schema.
+    """
+    current_user = await authenticate_websocket(websocket, token)
+    if current_user is None or current_user.id != user_id:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    connection_id = await manager.connect(websocket, user_id, last_seq, epoch)
+    connection = manager.active_connections[connection_id]
     
     try:
         while True:
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
+            message_data = await connection.receive()
+            manager.touch(connection_id)
+            presence.touch(user_id)
+            
+            if message_data["type"] == "pong":
+                # Answer to a server ping; the frame itself already counted as activity
+                continue
             
-            if message_data["type"] == "send_message":
+            elif message_data["type"] == "ping":
+                manager.send_to_connection(connection_id, PONG_EVENT)
+            
+            elif message_data["type"] == "ack":
+                retry_after = frame_limiter.check(connection, "receipt")
+                if retry_after:
+                    reject_rate_limited(connection_id, message_data, retry_after)
+                    continue
+                ack = parse_ack_frame(message_data)
+                if ack is None:
+                    manager.send_to_connection(connection_id, {
+                        "type": "error",
+                        "detail": "Invalid ack",
+                        "chat_id": message_data.get("chat_id")
+                    })
+                    continue
+                asyncio.create_task(handle_ack_frame(connection_id, user_id, *ack))
+            
+            elif message_data["type"] == "send_message":
+                # Rejected before any lookup, write or fan-out; the client retries with the same client_msg_id
+                retry_after = frame_limiter.check(connection, "message")
+                if retry_after:
+                    reject_rate_limited(connection_id, message_data, retry_after)
+                    continue
+                # Verify user is participant in the chat
+                participants = await get_chat_participants(message_data["chat_id"])
+                if participants is None or user_id not in participants:
+                    manager.send_to_connection(connection_id, {
+                        "type": "error",
+                        "detail": "Chat not found",
+                        "chat_id": message_data["chat_id"]
+                    })
+                    continue
+                
+                # A retried submission is acknowledged with the stored message, without a write or fan-out
+                client_msg_id = message_data.get("client_msg_id")
+                if client_msg_id:
+                    seen = find_client_message(user_id, client_msg_id)
+                    if seen is not None:
+                        asyncio.create_task(ack_duplicate_ws_send(connection_id, seen))
+                        continue
+                
                 # Create message
                 message = Message(
                     chat_id=message_data["chat_id"],
@@ -701,37 +3112,40 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     content=message_data["content"],
                     message_type=message_data.get("message_type", "text"),
                     replied_to=message_data.get("replied_to"),
+                    client_msg_id=client_msg_id,
+                    recipient_ids=[p for p in participants if p != user_id],
                     timestamp=datetime.utcnow(),  # Explicitly set UTC timestamp
                     status="sent"
                 )
                 
-                # Save to database
-                await db.messages.insert_one(message.dict())
-                
-                # Update chat last message time
-                await db.chats.update_one(
-                    {"id": message.chat_id},
-                    {"$set": {"last_message_at": datetime.utcnow()}}
+                # Hand the message to the write-behind batcher and keep reading frames;
+                # fan-out and the ack happen once the batch containing it is stored
+                persisted = message_writer.submit(message, list(participants))
+                if client_msg_id:
+                    recent_client_messages.set(client_message_key(user_id, client_msg_id), (message, persisted))
+                asyncio.create_task(complete_ws_send(connection_id, user_id, message, list(participants), persisted))
+                # Sending ends the typing indicator for this chat
+                typing_tracker.update(user_id, message.chat_id, message.recipient_ids, False)
+            
+            elif message_data["type"] == "typing":
+                if frame_limiter.check(connection, "typing"):
+                    # Indicators are best effort: excess frames are dropped without a reply
+                    continue
+                # Membership comes from the cache; typing never reaches Mongo beyond a cold cache miss
+                chat_id = message_data.get("chat_id")
+                participants = await get_chat_participants(chat_id) if chat_id else None
+                if participants is None or user_id not in participants:
+                    manager.send_to_connection(connection_id, {"type": "error", "detail": "Chat not found", "chat_id": chat_id})
+                    continue
+                typing_tracker.update(
+                    user_id, chat_id, [p for p in participants if p != user_id],
+                    bool(message_data.get("is_typing", True))
                 )
                 
-                # Get chat participants
-                chat = await db.chats.find_one({"id": message.chat_id})
-                if chat:
-                    # Send to all participants
-                    for participant_id in chat["participants"]:
-                        if participant_id != user_id:
-                            await manager.send_personal_message({
-                                "type": "new_message",
-                                "message": message.dict()
-                            }, participant_id)
-                
-                # Confirm message sent
-                await websocket.send_text(json.dumps({
-                    "type": "message_sent",
-                    "message": message.dict()
-                }))
-                
     except WebSocketDisconnect:
+        pass
+    finally:
+        # Any exit from the receive loop must release the connection and its writer task
         await manager.disconnect(connection_id, user_id)
 
 # Include the router in the main app
@@ -743,6 +3157,7 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Has-More", "X-Chat-Seq"],
 )
 
 # Configure logging
@@ -752,6 +3167,25 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def startup_db_client():
+    await ensure_indexes()
+    await backfill_committed_seq()
+    await backfill_unread_counters()
+    await fanout_bus.start()
+    presence.start()
+    manager.start_heartbeat()
+    if os.environ.get('VERIFY_INDEXES', '').lower() in ('1', 'true', 'yes'):
+        await verify_index_usage()
+    if os.environ.get('REBUILD_UNREAD_ON_STARTUP', '').lower() in ('1', 'true', 'yes'):
+        # Runs in the background so a full repair never delays startup
+        asyncio.create_task(rebuild_unread_counters({}))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    await message_writer.stop()
+    await manager.stop_heartbeat()
+    await presence.stop()
+    await fanout_bus.stop()
+    client.close()
+    password_hasher.executor.shutdown(wait=False)
\ No newline at end of file
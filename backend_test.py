@@ -676,7 +676,7 @@ class BasemappAPITester:
         message_id = response1.get('id')
         print(f"   Message sent with status: {response1.get('status', 'unknown')}")
         
-        # Get messages as user2 (should mark as read)
+        # Get messages as user2 (fetching does not mark them as read)
         success2, response2 = self.run_test(
             "Get Messages (User 2)",
             "GET",
@@ -687,6 +687,20 @@ class BasemappAPITester:
         
         if success2:
             print(f"   User 2 retrieved {len(response2)} messages")
+            fetched = next((m for m in response2 if m.get('id') == message_id), None)
+            if fetched and fetched.get('is_read'):
+                print("❌ Fetching messages marked them as read")
+                success2 = False
+        
+        # Reading is explicit
+        success_read, _ = self.run_test(
+            "Mark Message Read (User 2)",
+            "PUT",
+            f"messages/{message_id}/read",
+            200,
+            token=self.token2
+        )
+        success2 = success2 and success_read
             
         # Send reply from user2
         reply_data = {
@@ -0,0 +1,179 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+import websockets
+
+BACKEND_DIR = Path(__file__).parent / "backend"
+
+class FanoutBenchmark:
+    """Measures message fan-out throughput for an increasing number of uvicorn workers.
+
+    For each worker count a local server is started with FANOUT_BUS=unix and a
+    private socket dir, so the kernel spreads the receiver's WebSocket
+    connections over the workers and most deliveries cross the bus. The
+    sender posts messages over REST from several threads; every receiver
+    connection has to get every message. Needs the backend's MongoDB (MONGO_URL
+    in backend/.env) and two verified accounts, because registration requires
+    an email verification code.
+    """
+    def __init__(self, sender, receiver, worker_counts=(1, 2, 4), port=8011,
+                 messages=300, connections=8, send_threads=8):
+        self.sender = sender
+        self.receiver = receiver
+        self.worker_counts = worker_counts
+        self.port = port
+        self.messages = messages
+        self.connections = connections
+        self.send_threads = send_threads
+        self.base_url = f"http://127.0.0.1:{port}"
+        self.api_url = f"{self.base_url}/api"
+        self.ws_url = f"ws://127.0.0.1:{port}"
+        self.results = []
+
+    def start_server(self, workers, socket_dir):
+        env = dict(os.environ, FANOUT_BUS="unix", FANOUT_SOCKET_DIR=socket_dir)
+        return subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1",
+             "--port", str(self.port), "--workers", str(workers), "--log-level", "warning"],
+            cwd=BACKEND_DIR, env=env
+        )
+
+    def login(self, account, timeout=30.0):
+        """Log in, retrying while the workers are still starting"""
+        deadline = time.perf_counter() + timeout
+        while True:
+            try:
+                response = requests.post(f"{self.api_url}/auth/login", json=account, timeout=10)
+                if response.status_code == 200:
+                    token = response.json()['access_token']
+                    me = requests.get(f"{self.api_url}/auth/me",
+                                      headers={'Authorization': f"Bearer {token}"}, timeout=10)
+                    return token, me.json()['id']
+                print(f"❌ Login failed: {response.status_code}")
+                return None, None
+            except requests.ConnectionError:
+                if time.perf_counter() > deadline:
+                    print("❌ Server did not come up")
+                    return None, None
+                time.sleep(0.5)
+
+    async def receive(self, websocket, expected, latencies):
+        received = 0
+        while received < expected:
+            event = json.loads(await websocket.recv())
+            # Skips the offline inbox replayed on connect
+            if event.get("type") == "new_message" and event["message"]["content"].startswith("bench:"):
+                latencies.append((time.time() - float(event["message"]["content"][6:])) * 1000)
+                received += 1
+        return time.perf_counter()
+
+    def send_all(self, token, chat_id):
+        session = requests.Session()
+        headers = {'Authorization': f"Bearer {token}"}
+
+        def send(_):
+            # The content carries the send time so receivers can measure delivery latency
+            response = session.post(f"{self.api_url}/messages", headers=headers, timeout=30,
+                                    json={"chat_id": chat_id, "content": f"bench:{time.time()!r}", "message_type": "text"})
+            return response.status_code == 200
+
+        with ThreadPoolExecutor(max_workers=self.send_threads) as pool:
+            return sum(pool.map(send, range(self.messages)))
+
+    async def measure(self, workers):
+        with tempfile.TemporaryDirectory() as socket_dir:
+            server = self.start_server(workers, socket_dir)
+            try:
+                sender_token, _ = self.login(self.sender)
+                receiver_token, receiver_id = self.login(self.receiver)
+                if not (sender_token and receiver_token):
+                    return None
+                chat = requests.post(f"{self.api_url}/chats", params={"other_user_id": receiver_id},
+                                     headers={'Authorization': f"Bearer {sender_token}"}, timeout=10).json()
+
+                websockets_open = [
+                    await websockets.connect(f"{self.ws_url}/ws/{receiver_id}?token={receiver_token}")
+                    for _ in range(self.connections)
+                ]
+                latencies = []
+                try:
+                    receivers = [
+                        asyncio.create_task(self.receive(websocket, self.messages, latencies))
+                        for websocket in websockets_open
+                    ]
+                    started_at = time.perf_counter()
+                    sent = await asyncio.get_running_loop().run_in_executor(
+                        None, self.send_all, sender_token, chat['id'])
+                    if sent < self.messages:
+                        print(f"⚠️  Only {sent}/{self.messages} sends succeeded")
+                        for task in receivers:
+                            task.cancel()
+                        return None
+                    finished_at = max(await asyncio.wait_for(asyncio.gather(*receivers), timeout=60))
+                finally:
+                    for websocket in websockets_open:
+                        await websocket.close()
+
+                elapsed = finished_at - started_at
+                result = {
+                    "workers": workers,
+                    "deliveries": len(latencies),
+                    "elapsed": elapsed,
+                    "per_second": len(latencies) / elapsed,
+                    "p50_ms": statistics.median(latencies),
+                    "p99_ms": sorted(latencies)[int(0.99 * (len(latencies) - 1))]
+                }
+                self.results.append(result)
+                return result
+            finally:
+                server.terminate()
+                server.wait(timeout=30)
+
+    async def run(self):
+        print("🚀 Starting Fan-out Throughput vs Workers Benchmark")
+        print("=" * 50)
+        print(f"   {self.messages} messages x {self.connections} receiver connections, "
+              f"{self.send_threads} sender threads")
+        for workers in self.worker_counts:
+            print(f"\n🔍 {workers} worker(s)...")
+            result = await self.measure(workers)
+            if result is None:
+                return False
+            print(f"   deliveries={result['deliveries']} in {result['elapsed']:.2f}s "
+                  f"-> {result['per_second']:.0f}/s p50={result['p50_ms']:.1f}ms p99={result['p99_ms']:.1f}ms")
+
+        baseline = self.results[0]
+        print("\n📊 Relative to 1 worker:")
+        for result in self.results[1:]:
+            print(f"   {result['workers']} workers: throughput={result['per_second'] / baseline['per_second']:.2f}x "
+                  f"p99={result['p99_ms'] / baseline['p99_ms']:.2f}x")
+        return True
+
+async def main():
+    accounts = [(os.environ.get(f"BENCH_EMAIL{n}"), os.environ.get(f"BENCH_PASSWORD{n}")) for n in ("", "2")]
+    if not all(email and password for email, password in accounts):
+        print("❌ Set BENCH_EMAIL/BENCH_PASSWORD and BENCH_EMAIL2/BENCH_PASSWORD2 to two verified accounts")
+        return 1
+    benchmark = FanoutBenchmark(
+        sender={"email": accounts[0][0], "password": accounts[0][1]},
+        receiver={"email": accounts[1][0], "password": accounts[1][1]},
+        worker_counts=[int(n) for n in os.environ.get("BENCH_WORKERS", "1,2,4").split(",")],
+        port=int(os.environ.get("BENCH_PORT", "8011")),
+        messages=int(os.environ.get("BENCH_MESSAGES", "300")),
+        connections=int(os.environ.get("BENCH_CONNECTIONS", "8")),
+        send_threads=int(os.environ.get("BENCH_SEND_THREADS", "8"))
+    )
+    success = await benchmark.run()
+    return 0 if success else 1
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,139 @@
+import asyncio
+import websockets
+import requests
+import sys
+import os
+import time
+import threading
+import statistics
+
+class LoginBenchmark:
+    """Measures login throughput and WebSocket latency while logins are running.
+
+    Uses an existing verified account (BENCH_EMAIL / BENCH_PASSWORD) because
+    registration requires an email verification code.
+    """
+    def __init__(self, base_url="https://chat-sync-1.preview.emergentagent.com",
+                 email=None, password=None, login_threads=16, duration=15.0):
+        self.base_url = base_url
+        self.api_url = f"{base_url}/api"
+        self.ws_url = base_url.replace("https://", "wss://").replace("http://", "ws://")
+        self.email = email
+        self.password = password
+        self.login_threads = login_threads
+        self.duration = duration
+        self.user_id = None
+        self.token = None
+        self.login_times = []
+        self.login_statuses = {}
+        self.lock = threading.Lock()
+
+    def setup(self):
+        response = requests.post(f"{self.api_url}/auth/login",
+                                 json={"email": self.email, "password": self.password}, timeout=10)
+        if response.status_code != 200:
+            print(f"❌ Login failed: {response.status_code}")
+            return False
+        self.token = response.json()['access_token']
+        headers = {'Authorization': f"Bearer {self.token}"}
+        me = requests.get(f"{self.api_url}/auth/me", headers=headers, timeout=10)
+        if me.status_code != 200:
+            print(f"❌ Failed to get user info: {me.status_code}")
+            return False
+        self.user_id = me.json()['id']
+        print(f"✅ Benchmark user: {self.user_id[:8]}...")
+        return True
+
+    def login_worker(self, stop_event):
+        session = requests.Session()
+        while not stop_event.is_set():
+            start_time = time.perf_counter()
+            try:
+                response = session.post(f"{self.api_url}/auth/login",
+                                        json={"email": self.email, "password": self.password}, timeout=30)
+                status_code = response.status_code
+            except Exception:
+                status_code = "error"
+            elapsed = time.perf_counter() - start_time
+            with self.lock:
+                self.login_statuses[status_code] = self.login_statuses.get(status_code, 0) + 1
+                if status_code == 200:
+                    self.login_times.append(elapsed)
+
+    async def measure_ws_latency(self, duration, interval=0.05):
+        """Round-trip time of WebSocket ping frames, answered by the server event loop"""
+        latencies = []
+        async with websockets.connect(f"{self.ws_url}/ws/{self.user_id}?token={self.token}") as websocket:
+            deadline = time.perf_counter() + duration
+            while time.perf_counter() < deadline:
+                start_time = time.perf_counter()
+                pong_waiter = await websocket.ping()
+                await pong_waiter
+                latencies.append((time.perf_counter() - start_time) * 1000)
+                await asyncio.sleep(interval)
+        return latencies
+
+    @staticmethod
+    def percentile(values, pct):
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def report_latency(self, label, latencies):
+        print(f"   {label}: samples={len(latencies)} "
+              f"p50={self.percentile(latencies, 50):.2f}ms "
+              f"p99={self.percentile(latencies, 99):.2f}ms "
+              f"max={max(latencies) if latencies else 0:.2f}ms")
+
+    async def run(self):
+        print("🚀 Starting Login / WebSocket Latency Benchmark")
+        print("=" * 50)
+        if not self.setup():
+            return False
+
+        print("\n🔍 Idle WebSocket latency...")
+        idle_latencies = await self.measure_ws_latency(min(5.0, self.duration))
+        self.report_latency("idle", idle_latencies)
+
+        print(f"\n🔍 WebSocket latency with {self.login_threads} concurrent login threads...")
+        stop_event = threading.Event()
+        threads = [threading.Thread(target=self.login_worker, args=(stop_event,), daemon=True)
+                   for _ in range(self.login_threads)]
+        started_at = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        loaded_latencies = await self.measure_ws_latency(self.duration)
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started_at
+        self.report_latency("under login load", loaded_latencies)
+
+        successful = len(self.login_times)
+        print(f"\n📊 Logins: {successful} ok in {elapsed:.1f}s -> {successful / elapsed:.1f} logins/s")
+        if self.login_times:
+            print(f"   login p50={statistics.median(self.login_times) * 1000:.1f}ms "
+                  f"p99={self.percentile(self.login_times, 99) * 1000:.1f}ms")
+        print(f"   status codes: {self.login_statuses}")
+        return True
+
+async def main():
+    email = os.environ.get("BENCH_EMAIL")
+    password = os.environ.get("BENCH_PASSWORD")
+    if not email or not password:
+        print("❌ Set BENCH_EMAIL and BENCH_PASSWORD to a verified account")
+        return 1
+    benchmark = LoginBenchmark(
+        base_url=os.environ.get("BENCH_BASE_URL", "https://chat-sync-1.preview.emergentagent.com"),
+        email=email,
+        password=password,
+        login_threads=int(os.environ.get("BENCH_LOGIN_THREADS", "16")),
+        duration=float(os.environ.get("BENCH_DURATION", "15"))
+    )
+    success = await benchmark.run()
+    return 0 if success else 1
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,342 @@
+import random
+import requests
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+class SyncScenarioTester:
+    """Scenarios for message pagination, delta sync cursors, read watermarks and client_msg_id retries"""
+    def __init__(self, base_url="https://chat-sync-1.preview.emergentagent.com"):
+        self.base_url = base_url
+        self.api_url = f"{base_url}/api"
+        self.token1 = None
+        self.token2 = None
+        self.user1_id = None
+        self.user2_id = None
+        self.chat_id = None
+        self.last_response = None
+        self.tests_run = 0
+        self.tests_passed = 0
+
+    def run_test(self, name, method, endpoint, expected_status, data=None, token=None, params=None):
+        """Run a single API test; the raw response stays in self.last_response for headers"""
+        url = f"{self.api_url}/{endpoint}"
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+
+        self.tests_run += 1
+        print(f"\n🔍 Testing {name}...")
+
+        try:
+            if method == 'GET':
+                response = requests.get(url, headers=headers, params=params)
+            elif method == 'POST':
+                response = requests.post(url, json=data, headers=headers, params=params)
+            elif method == 'PUT':
+                response = requests.put(url, json=data, headers=headers)
+            elif method == 'DELETE':
+                response = requests.delete(url, headers=headers)
+            self.last_response = response
+
+            success = response.status_code == expected_status
+            if success:
+                self.tests_passed += 1
+                print(f"✅ Passed - Status: {response.status_code}")
+                try:
+                    return success, response.json()
+                except:
+                    return success, {}
+            else:
+                print(f"❌ Failed - Expected {expected_status}, got {response.status_code}")
+                try:
+                    error_detail = response.json()
+                    print(f"   Error details: {error_detail}")
+                except:
+                    print(f"   Response text: {response.text}")
+                return False, {}
+
+        except Exception as e:
+            print(f"❌ Failed - Error: {str(e)}")
+            return False, {}
+
+    def check(self, name, condition, detail=""):
+        """Record an expectation on data already fetched"""
+        self.tests_run += 1
+        if condition:
+            self.tests_passed += 1
+            print(f"✅ {name}")
+        else:
+            print(f"❌ {name} {detail}")
+        return condition
+
+    def setup(self):
+        """Log in two verified test users and open a chat between them"""
+        test_users = [
+            {"email": "realtime.user1@basemapp.com", "password": "TestPassword123!"},
+            {"email": "realtime.user2@basemapp.com", "password": "TestPassword123!"},
+            {"email": "status.test.user1@basemapp.com", "password": "StatusTest123!"},
+            {"email": "status.test.user2@basemapp.com", "password": "StatusTest123!"}
+        ]
+        tokens = []
+        for i, user_data in enumerate(test_users):
+            success, response = self.run_test(f"Login test user {i+1}", "POST", "auth/login", 200, data=user_data)
+            if success and 'access_token' in response:
+                tokens.append(response['access_token'])
+                if len(tokens) >= 2:
+                    break
+        if len(tokens) < 2:
+            print("❌ Two verified test users are required")
+            return False
+        self.token1, self.token2 = tokens
+
+        success1, me1 = self.run_test("Get user 1", "GET", "auth/me", 200, token=self.token1)
+        success2, me2 = self.run_test("Get user 2", "GET", "auth/me", 200, token=self.token2)
+        if not (success1 and success2):
+            return False
+        self.user1_id, self.user2_id = me1['id'], me2['id']
+
+        success, chat = self.run_test("Open chat", "POST", "chats", 200, token=self.token1,
+                                      params={"other_user_id": self.user2_id})
+        if not success:
+            return False
+        self.chat_id = chat['id']
+        print(f"   Chat ID: {self.chat_id}")
+        return True
+
+    def send(self, content, token=None, client_msg_id=None):
+        data = {"chat_id": self.chat_id, "content": content, "message_type": "text"}
+        if client_msg_id:
+            data["client_msg_id"] = client_msg_id
+        success, response = self.run_test(f"Send '{content}'", "POST", "messages", 200,
+                                          data=data, token=token or self.token1)
+        return response if success else None
+
+    def unread_count(self, token):
+        success, chats = self.run_test("Get chats", "GET", "chats", 200, token=token)
+        if not success:
+            return None
+        chat = next((c for c in chats if c['id'] == self.chat_id), None)
+        return chat.get('unread_count') if chat else None
+
+    def test_pagination_cursors(self):
+        """Keyset pages walk backwards with `before` and forwards with `after` without gaps or overlap"""
+        print("\n📄 Pagination cursors...")
+        sent = [self.send(f"صفحة {i}") for i in range(5)]
+        if not all(sent):
+            return False
+        sent_ids = [m['id'] for m in sent]
+
+        success, latest = self.run_test("Latest page", "GET", f"chats/{self.chat_id}/messages", 200,
+                                        token=self.token2, params={"limit": 2})
+        if not success:
+            return False
+        ok = self.check("Latest page holds the two newest messages", [m['id'] for m in latest] == sent_ids[-2:])
+        ok &= self.check("X-Has-More is true on the latest page",
+                         self.last_response.headers.get('X-Has-More') == "true")
+
+        success, older = self.run_test("Older page", "GET", f"chats/{self.chat_id}/messages", 200,
+                                       token=self.token2, params={"limit": 2, "before": latest[0]['id']})
+        if not success:
+            return False
+        ok &= self.check("Older page continues right before the latest one", [m['id'] for m in older] == sent_ids[1:3])
+
+        success, newer = self.run_test("Newer page", "GET", f"chats/{self.chat_id}/messages", 200,
+                                       token=self.token2, params={"limit": 2, "after": older[-1]['id']})
+        if not success:
+            return False
+        ok &= self.check("Newer page returns to the latest page", [m['id'] for m in newer] == sent_ids[-2:])
+        ok &= self.check("X-Has-More is false at the newest end",
+                         self.last_response.headers.get('X-Has-More') == "false")
+
+        success, _ = self.run_test("before and after together", "GET", f"chats/{self.chat_id}/messages", 400,
+                                   token=self.token2, params={"before": sent_ids[0], "after": sent_ids[1]})
+        return ok and success
+
+    def test_delta_sync_cursor(self):
+        """/changes returns each change once and moves the cursor even when nothing is left to return"""
+        print("\n🔄 Delta sync cursor advancement...")
+        success, _ = self.run_test("Starting page", "GET", f"chats/{self.chat_id}/messages", 200,
+                                   token=self.token2, params={"limit": 1})
+        if not success:
+            return False
+        cursor = int(self.last_response.headers.get('X-Chat-Seq', 0))
+
+        message = self.send("تغيير جديد")
+        if not message:
+            return False
+        success, changes = self.run_test("Changes since X-Chat-Seq", "GET", f"chats/{self.chat_id}/changes", 200,
+                                         token=self.token2, params={"since": cursor})
+        if not success:
+            return False
+        ok = self.check("New message is in the changes", message['id'] in [m['id'] for m in changes['messages']])
+        ok &= self.check("Cursor moved forward", changes['cursor'] > cursor, f"({changes['cursor']} <= {cursor})")
+        cursor = changes['cursor']
+
+        success, again = self.run_test("Changes since the new cursor", "GET", f"chats/{self.chat_id}/changes", 200,
+                                       token=self.token2, params={"since": cursor})
+        ok &= self.check("Nothing is returned twice", success and not again['messages'])
+
+        # Reading writes a sequence without any message row; the cursor still has to pass it
+        success, _ = self.run_test("Mark chat read (User 2)", "POST", f"chats/{self.chat_id}/read", 200, token=self.token2)
+        success, idle = self.run_test("Changes after a read", "GET", f"chats/{self.chat_id}/changes", 200,
+                                      token=self.token2, params={"since": cursor})
+        ok &= self.check("Cursor passes sequences without rows", success and idle['cursor'] > cursor and not idle['has_more'])
+        cursor = idle['cursor'] if success else cursor
+        success, settled = self.run_test("Changes at the advanced cursor", "GET", f"chats/{self.chat_id}/changes", 200,
+                                         token=self.token2, params={"since": cursor})
+        ok &= self.check("Advanced cursor is stable", success and settled['cursor'] == cursor and not settled['messages'])
+
+        deleted = self.send("رسالة ستحذف")
+        if not deleted:
+            return False
+        success, _ = self.run_test("Delete message", "DELETE", f"messages/{deleted['id']}", 200, token=self.token1)
+        success, synced = self.run_test("Sync across chats", "POST", "sync", 200, token=self.token2,
+                                        data={"cursors": {self.chat_id: cursor}})
+        chat_changes = next((c for c in synced.get('chats', []) if c['chat_id'] == self.chat_id), None) if success else None
+        ok &= self.check("/sync reports the deleted message", chat_changes is not None and deleted['id'] in chat_changes['deleted'])
+        return ok
+
+    def test_watermark_and_unread(self):
+        """Unread counters follow sends, read watermarks and deletes"""
+        print("\n📬 Read watermarks and unread counts...")
+        success, _ = self.run_test("Mark chat read (User 2)", "POST", f"chats/{self.chat_id}/read", 200, token=self.token2)
+        if not success:
+            return False
+        ok = self.check("Unread count starts at 0", self.unread_count(self.token2) == 0)
+
+        sent = [self.send(f"غير مقروءة {i}") for i in range(3)]
+        if not all(sent):
+            return False
+        ok &= self.check("Three sends count three unread", self.unread_count(self.token2) == 3)
+
+        success, _ = self.run_test("Fetch messages (User 2)", "GET", f"chats/{self.chat_id}/messages", 200, token=self.token2)
+        ok &= self.check("Fetching does not read", self.unread_count(self.token2) == 3)
+
+        success, _ = self.run_test("Read up to the second message", "PUT", f"messages/{sent[1]['id']}/read", 200, token=self.token2)
+        ok &= self.check("Watermark leaves one unread", self.unread_count(self.token2) == 1)
+
+        success, _ = self.run_test("Delete the unread message", "DELETE", f"messages/{sent[2]['id']}", 200, token=self.token1)
+        ok &= self.check("Deleting an unread message lowers the count", self.unread_count(self.token2) == 0)
+
+        success, _ = self.run_test("Delete an already read message", "DELETE", f"messages/{sent[0]['id']}", 200, token=self.token1)
+        ok &= self.check("Deleting a read message leaves the count", self.unread_count(self.token2) == 0)
+
+        self.send("أخيرة")
+        ok &= self.check("A new message counts again", self.unread_count(self.token2) == 1)
+        success, _ = self.run_test("Mark chat read (User 2)", "POST", f"chats/{self.chat_id}/read", 200, token=self.token2)
+        ok &= self.check("Reading the chat clears the count", self.unread_count(self.token2) == 0)
+        ok &= self.check("Sender's own messages are never unread", self.unread_count(self.token1) == 0)
+        return ok
+
+    def unread_in_latest_page(self, token, sender_id):
+        """Messages from `sender_id` on the latest page that the reader's watermark has not passed"""
+        success, messages = self.run_test("Latest page", "GET", f"chats/{self.chat_id}/messages", 200,
+                                          token=token, params={"limit": 200})
+        if not success:
+            return None
+        return sum(1 for m in messages if m['sender_id'] == sender_id and not m.get('is_read'))
+
+    def test_concurrent_unread_consistency(self):
+        """Unread counters match the messages above each watermark after concurrent sends, reads and deletes"""
+        print("\n🌪️ Concurrent unread consistency...")
+        self.run_test("Mark chat read (User 1)", "POST", f"chats/{self.chat_id}/read", 200, token=self.token1)
+        self.run_test("Mark chat read (User 2)", "POST", f"chats/{self.chat_id}/read", 200, token=self.token2)
+        headers1 = {'Authorization': f'Bearer {self.token1}'}
+        headers2 = {'Authorization': f'Bearer {self.token2}'}
+        sent_by_user1 = []
+
+        def send(headers, content):
+            response = requests.post(f"{self.api_url}/messages", headers=headers,
+                                     json={"chat_id": self.chat_id, "content": content, "message_type": "text"})
+            return response.json() if response.status_code == 200 else None
+
+        def send_from_user1(i):
+            message = send(headers1, f"عاصفة {i}")
+            if message:
+                sent_by_user1.append(message)
+            return message is not None
+
+        def read_as_user2(_):
+            # Reads race the sends; any message already stored is a valid watermark target
+            if not sent_by_user1:
+                return True
+            message = random.choice(sent_by_user1)
+            response = requests.put(f"{self.api_url}/messages/{message['id']}/read", headers=headers2)
+            return response.status_code == 200
+
+        def send_and_delete_as_user2(i):
+            # User 1 never reads during the storm, so these deletes never overlap a read of the same message
+            message = send(headers2, f"تحذف {i}")
+            if not message:
+                return False
+            if i % 2:
+                return True
+            response = requests.delete(f"{self.api_url}/messages/{message['id']}", headers=headers2)
+            return response.status_code == 200
+
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            jobs = [pool.submit(send_from_user1, i) for i in range(30)]
+            jobs += [pool.submit(read_as_user2, i) for i in range(10)]
+            jobs += [pool.submit(send_and_delete_as_user2, i) for i in range(10)]
+            storm_ok = all(job.result() for job in jobs)
+        ok = self.check("Every concurrent request succeeded", storm_ok)
+
+        expected2 = self.unread_in_latest_page(self.token2, self.user1_id)
+        counted2 = self.unread_count(self.token2)
+        ok &= self.check("User 2 counter matches its unread messages", counted2 == expected2,
+                         f"(counter {counted2}, messages {expected2})")
+        expected1 = self.unread_in_latest_page(self.token1, self.user2_id)
+        counted1 = self.unread_count(self.token1)
+        ok &= self.check("User 1 counter matches its unread messages after deletes", counted1 == expected1 == 5,
+                         f"(counter {counted1}, messages {expected1})")
+        return ok
+
+    def test_client_msg_id_retry(self):
+        """A retried send returns the stored message and is stored, fanned out and counted once"""
+        print("\n🔁 client_msg_id retries...")
+        self.run_test("Mark chat read (User 2)", "POST", f"chats/{self.chat_id}/read", 200, token=self.token2)
+        client_msg_id = str(uuid.uuid4())
+        first = self.send("مرة واحدة فقط", client_msg_id=client_msg_id)
+        retry = self.send("مرة واحدة فقط", client_msg_id=client_msg_id)
+        if not (first and retry):
+            return False
+        ok = self.check("Retry returns the original message", retry['id'] == first['id'])
+        ok &= self.check("Retry is counted once", self.unread_count(self.token2) == 1)
+
+        success, messages = self.run_test("Latest page", "GET", f"chats/{self.chat_id}/messages", 200, token=self.token2)
+        ok &= self.check("Retry is stored once",
+                         success and sum(1 for m in messages if m.get('client_msg_id') == client_msg_id) == 1)
+
+        other = self.send("مرة واحدة فقط", client_msg_id=str(uuid.uuid4()))
+        ok &= self.check("Another client_msg_id is a new message", other is not None and other['id'] != first['id'])
+        return ok
+
+    def run_sync_scenarios(self):
+        print("🚀 Starting Sync Scenario Tests")
+        print("=" * 60)
+        if not self.setup():
+            print("❌ Setup failed, cannot run sync scenarios")
+            return False
+
+        results = [
+            ("Pagination cursors", self.test_pagination_cursors()),
+            ("Delta sync cursor", self.test_delta_sync_cursor()),
+            ("Read watermarks and unread counts", self.test_watermark_and_unread()),
+            ("client_msg_id retry", self.test_client_msg_id_retry()),
+            ("Concurrent unread consistency", self.test_concurrent_unread_consistency())
+        ]
+
+        print("\n" + "=" * 60)
+        for name, success in results:
+            print(f"   {name}: {'✅' if success else '❌'}")
+        print(f"📈 Checks passed: {self.tests_passed}/{self.tests_run}")
+        return all(success for _, success in results)
+
+def main():
+    tester = SyncScenarioTester()
+    success = tester.run_sync_scenarios()
+    return 0 if success else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+import json
+import os
+import sys
+import time
+import uuid
+import random
+from datetime import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ARABIC_SAMPLES = [
+    "مرحبا، كيف حالك اليوم؟",
+    "سأصل بعد عشر دقائق إن شاء الله",
+    "هل رأيت الرسالة التي أرسلتها لك أمس بخصوص الاجتماع؟",
+    "تمام 👍",
+    "شكراً جزيلاً على المساعدة، أقدر ذلك كثيراً",
+]
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class WireFormatBenchmark:
+    """Compares CPU per message and bytes on the wire for the WebSocket formats.
+
+    Events have the shape the server fans out (new_message with uuids, Arabic
+    content and timestamps, receipts batches); encoding mirrors the server:
+    stdlib json with ensure_ascii=False, orjson when installed, and msgpack
+    with datetimes as ISO strings.
+    """
+    def __init__(self, messages=20000, seed=7):
+        self.messages = messages
+        random.seed(seed)
+        self.events = [self.make_event(i) for i in range(messages)]
+        self.results = []
+
+    def make_event(self, index):
+        chat_id = str(uuid.uuid4())
+        sender_id = str(uuid.uuid4())
+        if index % 10 == 9:
+            return {
+                "seq": index,
+                "type": "receipts",
+                "status": "delivered",
+                "by": sender_id,
+                "at": datetime.utcnow(),
+                "chats": {chat_id: [str(uuid.uuid4()) for _ in range(random.randint(1, 8))]}
+            }
+        return {
+            "seq": index,
+            "type": "new_message",
+            "message": {
+                "id": str(uuid.uuid4()),
+                "chat_id": chat_id,
+                "sender_id": sender_id,
+                "content": random.choice(ARABIC_SAMPLES),
+                "message_type": "text",
+                "timestamp": datetime.utcnow(),
+                "is_read": False,
+                "replied_to": None,
+                "status": "sent",
+                "delivered_at": None,
+                "read_at": None,
+                "seq": index,
+                "change_seq": index,
+                "client_msg_id": str(uuid.uuid4()),
+                "recipient_ids": [str(uuid.uuid4())]
+            }
+        }
+
+    def formats(self):
+        formats = [(
+            "json",
+            lambda event: json.dumps(event, default=json_default, ensure_ascii=False).encode(),
+            json.loads
+        )]
+        if orjson is not None:
+            formats.append(("orjson", orjson.dumps, orjson.loads))
+        if msgpack is not None:
+            formats.append((
+                "msgpack",
+                lambda event: msgpack.packb(event, default=json_default, use_bin_type=True),
+                lambda data: msgpack.unpackb(data, raw=False)
+            ))
+        return formats
+
+    def measure(self, name, encode, decode):
+        start = time.process_time()
+        frames = [encode(event) for event in self.events]
+        encode_cpu = time.process_time() - start
+        start = time.process_time()
+        for frame in frames:
+            decode(frame)
+        decode_cpu = time.process_time() - start
+        total_bytes = sum(len(frame) for frame in frames)
+        result = {
+            "format": name,
+            "encode_us": encode_cpu / self.messages * 1e6,
+            "decode_us": decode_cpu / self.messages * 1e6,
+            "bytes": total_bytes / self.messages
+        }
+        self.results.append(result)
+        return result
+
+    def run(self):
+        print("🚀 Starting WebSocket Wire Format Benchmark")
+        print("=" * 50)
+        print(f"   {self.messages} events (90% new_message, 10% receipts)")
+        if msgpack is None:
+            print("⚠️  msgpack is not installed; only JSON formats are measured")
+        for name, encode, decode in self.formats():
+            result = self.measure(name, encode, decode)
+            print(f"   {name:8s} encode={result['encode_us']:.2f}µs "
+                  f"decode={result['decode_us']:.2f}µs bytes/msg={result['bytes']:.1f}")
+
+        baseline = self.results[0]
+        print("\n📊 Relative to stdlib json:")
+        for result in self.results[1:]:
+            print(f"   {result['format']:8s} cpu={self.ratio(result, baseline):.2f}x "
+                  f"bytes={result['bytes'] / baseline['bytes']:.2f}x")
+        return True
+
+    @staticmethod
+    def ratio(result, baseline):
+        return (result["encode_us"] + result["decode_us"]) / (baseline["encode_us"] + baseline["decode_us"])
+
+def main():
+    benchmark = WireFormatBenchmark(messages=int(os.environ.get("BENCH_MESSAGES", "20000")))
+    return 0 if benchmark.run() else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+import asyncio
+import os
+import sys
+import time
+import uuid
+from pathlib import Path
+
+# The benchmark writes to its own database next to the configured one
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+from dotenv import load_dotenv
+load_dotenv(Path(__file__).parent / "backend" / ".env")
+os.environ["DB_NAME"] = f"{os.environ.get('DB_NAME', 'basemapp')}_write_batch_bench"
+
+import server
+
+class WriteBatchBenchmark:
+    """Compares message persistence throughput of the per-message REST path and the WebSocket group commit.
+
+    The per-message path runs what POST /messages does: allocate the sequence,
+    insert_one, then commit the chat (preview, unread, committed_seq). The
+    batched path submits the same messages to MessageWriteBatcher, which uses
+    one insert_many and one allocation/commit per chat per batch. Both run
+    with `concurrency` senders in flight across `chats` chats, against the
+    MongoDB from backend/.env.
+    """
+    def __init__(self, messages=5000, chats=20, concurrency=200):
+        self.messages = messages
+        self.chats = chats
+        self.concurrency = concurrency
+        self.chat_ids = []
+        self.results = []
+
+    async def setup(self):
+        await server.db.chats.delete_many({})
+        await server.db.messages.delete_many({})
+        for _ in range(self.chats):
+            chat = server.Chat(participants=[str(uuid.uuid4()), str(uuid.uuid4())])
+            await server.db.chats.insert_one(chat.dict())
+            self.chat_ids.append((chat.id, chat.participants))
+
+    def make_messages(self):
+        messages = []
+        for index in range(self.messages):
+            chat_id, participants = self.chat_ids[index % self.chats]
+            messages.append((server.Message(
+                chat_id=chat_id, sender_id=participants[0], content=f"رسالة {index}",
+                recipient_ids=participants[1:]
+            ), participants))
+        return messages
+
+    async def send_one(self, message, participants):
+        chat = await server.assign_message_seq(message)
+        stored = False
+        try:
+            await server.db.messages.insert_one(message.dict())
+            stored = True
+        finally:
+            await server.commit_messages(message.chat_id, message.seq, message.seq,
+                                         [(message, participants)] if stored else [])
+
+    async def run_per_message(self, messages):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send(message, participants):
+            async with semaphore:
+                await self.send_one(message, participants)
+
+        await asyncio.gather(*[send(message, participants) for message, participants in messages])
+
+    async def run_batched(self, messages):
+        writer = server.MessageWriteBatcher(server.WS_WRITE_BATCH_SIZE, server.WS_WRITE_BATCH_DELAY)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send(message, participants):
+            async with semaphore:
+                await writer.submit(message, participants)
+
+        await asyncio.gather(*[send(message, participants) for message, participants in messages])
+        await writer.stop()
+        return writer.stats()
+
+    async def measure(self, name, runner):
+        messages = self.make_messages()
+        start_time = time.perf_counter()
+        extra = await runner(messages)
+        elapsed = time.perf_counter() - start_time
+        stored = await server.db.messages.count_documents({"id": {"$in": [message.id for message, _ in messages]}})
+        result = {"path": name, "elapsed": elapsed, "per_second": self.messages / elapsed, "stored": stored}
+        self.results.append(result)
+        print(f"   {name:12s} {self.messages} messages in {elapsed:.2f}s -> {result['per_second']:.0f} msgs/s "
+              f"(stored {stored})" + (f" average batch={extra['average_batch']}" if extra else ""))
+        return result
+
+    async def run(self):
+        print("🚀 Starting Message Write Batching Benchmark")
+        print("=" * 50)
+        print(f"   {self.messages} messages over {self.chats} chats, {self.concurrency} in flight, "
+              f"batch size {server.WS_WRITE_BATCH_SIZE}, delay {server.WS_WRITE_BATCH_DELAY * 1000:.1f}ms")
+        await self.setup()
+        try:
+            per_message = await self.measure("per-message", self.run_per_message)
+            batched = await self.measure("batched", self.run_batched)
+        finally:
+            await server.client.drop_database(os.environ["DB_NAME"])
+
+        print(f"\n📊 Batched throughput: {batched['per_second'] / per_message['per_second']:.1f}x per-message")
+        return per_message["stored"] == batched["stored"] == self.messages
+
+async def main():
+    benchmark = WriteBatchBenchmark(
+        messages=int(os.environ.get("BENCH_MESSAGES", "5000")),
+        chats=int(os.environ.get("BENCH_CHATS", "20")),
+        concurrency=int(os.environ.get("BENCH_CONCURRENCY", "200"))
+    )
+    success = await benchmark.run()
+    return 0 if success else 1
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
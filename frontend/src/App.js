@@ -10,6 +10,17 @@ import ContactsSync from './ContactsSync';
 
 const API = `${process.env.REACT_APP_BACKEND_URL || 'http://localhost:8001'}/api`;
 
+// الخادم يعيد آخر صفحة فقط، لذا نحتفظ بالرسائل الأقدم المحمّلة ونستبدل الجزء الأحدث
+const mergeLatestPage = (current, page) => {
+  if (page.length === 0) return current;
+  const pageIds = new Set(page.map(msg => msg.id));
+  const firstTimestamp = page[0].timestamp;
+  const older = current.filter(msg =>
+    !pageIds.has(msg.id) && !String(msg.id).startsWith('temp-') && msg.timestamp < firstTimestamp
+  );
+  return [...older, ...page];
+};
+
 function App() {
   const [token, setToken] = useState(localStorage.getItem('token'));
   const [user, setUser] = useState(null);
@@ -36,6 +47,8 @@ function App() {
   const [contactSearchQuery, setContactSearchQuery] = useState('');
   const [messageCache, setMessageCache] = useState({});
   const [isLoadingMessages, setIsLoadingMessages] = useState(false);
+  const [hasOlderMessages, setHasOlderMessages] = useState({}); // {chatId: bool} من ترويسة X-Has-More
+  const [isLoadingOlder, setIsLoadingOlder] = useState(false);
   const [messageDrafts, setMessageDrafts] = useState({}); // حفظ المسودات
   const [isTyping, setIsTyping] = useState(false);
   const [typingUsers, setTypingUsers] = useState({}); // {chatId: {userId: timestamp}}
@@ -43,6 +56,8 @@ function App() {
   const [currentView, setCurrentView] = useState('chats'); // 'chats' أو 'chat'
   
   const messagesEndRef = useRef(null);
+  const messagesContainerRef = useRef(null);
+  const skipAutoScrollRef = useRef(false);
   const contactsSync = useRef(null);
 
   // تحميل جهات الاتصال المحفوظة عند بدء التطبيق
@@ -612,6 +627,10 @@ function App() {
     try {
       const response = await axios.get(`${API}/chats/${chatId}/messages`);
       const messagesData = response.data;
+      setHasOlderMessages(prev => ({
+        ...prev,
+        [chatId]: response.headers['x-has-more'] === 'true'
+      }));
       
       // حفظ في الـ cache  
       setMessageCache(prev => ({
@@ -627,6 +646,51 @@ function App() {
     }
   };
 
+  // تحميل الصفحة الأقدم عند الطلب (التمرير للأعلى أو زر التحميل)
+  const loadOlderMessages = async () => {
+    if (!selectedChat || isLoadingOlder || !hasOlderMessages[selectedChat.id]) return;
+    const oldest = messages.find(msg => !String(msg.id).startsWith('temp-'));
+    if (!oldest) return;
+
+    const chatId = selectedChat.id;
+    const container = messagesContainerRef.current;
+    const previousHeight = container ? container.scrollHeight : 0;
+    setIsLoadingOlder(true);
+    try {
+      const response = await axios.get(`${API}/chats/${chatId}/messages`, {
+        params: { before: oldest.id }
+      });
+      const olderMessages = response.data;
+      setHasOlderMessages(prev => ({
+        ...prev,
+        [chatId]: response.headers['x-has-more'] === 'true'
+      }));
+
+      const existingIds = new Set(messages.map(msg => msg.id));
+      const combined = [...olderMessages.filter(msg => !existingIds.has(msg.id)), ...messages];
+      skipAutoScrollRef.current = true;
+      setMessages(combined);
+      setMessageCache(prev => ({ ...prev, [chatId]: combined }));
+
+      // الحفاظ على موضع القراءة بعد إضافة الرسائل في الأعلى
+      requestAnimationFrame(() => {
+        if (container) {
+          container.scrollTop += container.scrollHeight - previousHeight;
+        }
+      });
+    } catch (error) {
+      console.error('Failed to load older messages:', error);
+    } finally {
+      setIsLoadingOlder(false);
+    }
+  };
+
+  const handleMessagesScroll = (event) => {
+    if (event.currentTarget.scrollTop < 80) {
+      loadOlderMessages();
+    }
+  };
+
   // تنظيف وحماية النص من XSS
   const sanitizeMessage = (text) => {
     return text
@@ -1050,6 +1114,11 @@ function App() {
 
   // Auto scroll to bottom
   useEffect(() => {
+    if (skipAutoScrollRef.current) {
+      // تحميل الرسائل الأقدم لا ينقل المستخدم إلى الأسفل
+      skipAutoScrollRef.current = false;
+      return;
+    }
     if (messagesEndRef.current) {
       messagesEndRef.current.scrollIntoView({ behavior: 'smooth' });
     }
@@ -1058,7 +1127,9 @@ function App() {
   // نظام الإشعارات الفورية مع الصوت والتحسينات
   useEffect(() => {
     let intervalId = null;
-    let lastMessageCount = messages.length;
+    let eventSource = null;
+    // الرسائل تأتي كصفحة أخيرة محدودة، لذا نقارن آخر رسالة بدلاً من العدد
+    let lastMessageId = messages.length > 0 ? messages[messages.length - 1].id : null;
     
     if (selectedChat && user) {
       const checkForNewMessages = async () => {
@@ -1067,7 +1138,7 @@ function App() {
           const newMessages = response.data;
           
           // التحقق من وجود رسائل جديدة
-          if (newMessages.length > lastMessageCount) {
+          if (newMessages.length > 0 && newMessages[newMessages.length - 1].id !== lastMessageId) {
             const latestMessage = newMessages[newMessages.length - 1];
             
             // تحديث حالة الرسائل الجديدة إلى delivered إذا لم تكن من المستخدم الحالي
@@ -1131,11 +1202,14 @@ function App() {
               return msg;
             });
             
-            setMessages(updatedMessages);
-            setMessageCache(prev => ({
-              ...prev,
-              [selectedChat.id]: updatedMessages
-            }));
+            setMessages(prev => {
+              const merged = mergeLatestPage(prev, updatedMessages);
+              setMessageCache(cache => ({
+                ...cache,
+                [selectedChat.id]: merged
+              }));
+              return merged;
+            });
             
             // تحديث قاعدة البيانات للرسائل المقروءة فوراً
             const instantReadMessages = updatedMessages.filter(msg => 
@@ -1148,18 +1222,40 @@ function App() {
               updateMessageStatus(messageIds, 'read');
             }
             
-            lastMessageCount = newMessages.length;
+            lastMessageId = newMessages[newMessages.length - 1].id;
           }
         } catch (error) {
           console.error('خطأ في تحديث الرسائل:', error);
         }
       };
 
-      // بدء polling كل 5 ثوان (محسّن من 3 ثوان للأداء)
-      intervalId = setInterval(checkForNewMessages, 5000);
+      if ('EventSource' in window) {
+        // بث الأحداث من الخادم: نعيد الجلب فقط عند وصول حدث يخص المحادثة المفتوحة
+        eventSource = new EventSource(`${API}/events?token=${encodeURIComponent(token)}`);
+        eventSource.onmessage = (event) => {
+          try {
+            const data = JSON.parse(event.data);
+            const chatId = data.message?.chat_id || data.chat_id;
+            const touchesChat = chatId === selectedChat.id ||
+              (data.chats && selectedChat.id in data.chats) ||
+              data.type === 'message_read';
+            if (data.type === 'resync_required' || touchesChat) {
+              checkForNewMessages();
+            }
+          } catch (error) {
+            console.error('خطأ في قراءة حدث الخادم:', error);
+          }
+        };
+      } else {
+        // بدء polling كل 5 ثوان (محسّن من 3 ثوان للأداء)
+        intervalId = setInterval(checkForNewMessages, 5000);
+      }
     }
 
     return () => {
+      if (eventSource) {
+        eventSource.close();
+      }
       if (intervalId) {
         clearInterval(intervalId);
       }
@@ -1224,7 +1320,7 @@ function App() {
               }
               return msg;
             });
-            setMessages(updatedMessages);
+            setMessages(prev => mergeLatestPage(prev, updatedMessages));
             
             // تحديث قاعدة البيانات
             await updateMessageStatus(messageIds, 'read');
@@ -1693,7 +1789,22 @@ function App() {
           </div>
 
           {/* Messages - مع التمرير المحسن */}
-          <div className="messages-container-with-sticky px-3 sm:px-4 space-y-3 sm:space-y-4 messages-container">
+          <div
+            ref={messagesContainerRef}
+            onScroll={handleMessagesScroll}
+            className="messages-container-with-sticky px-3 sm:px-4 space-y-3 sm:space-y-4 messages-container"
+          >
+            {!isLoadingMessages && selectedChat && hasOlderMessages[selectedChat.id] && (
+              <div className="flex justify-center pt-2">
+                <button
+                  onClick={loadOlderMessages}
+                  disabled={isLoadingOlder}
+                  className="text-xs text-emerald-700 bg-emerald-50 hover:bg-emerald-100 px-3 py-1 rounded-full disabled:opacity-50"
+                >
+                  {isLoadingOlder ? 'جاري التحميل...' : 'تحميل الرسائل الأقدم'}
+                </button>
+              </div>
+            )}
             {isLoadingMessages ? (
               <div className="flex items-center justify-center h-32">
                 <div className="flex items-center space-x-2 space-x-reverse text-gray-500">
@@ -0,0 +1,312 @@
+import asyncio
+import websockets
+import json
+import os
+import requests
+import sys
+import time
+import uuid
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+class WebSocketScenarioTester:
+    """Live-server scenarios for the WebSocket protocol: resume, acks, heartbeat, typing, rate limits and msgpack.
+
+    Uses the verified test accounts, because registration requires an email
+    verification code. Timings follow the server defaults and can be
+    overridden with the same environment variables the server reads.
+    """
+    def __init__(self, base_url="https://chat-sync-1.preview.emergentagent.com"):
+        self.base_url = base_url
+        self.api_url = f"{base_url}/api"
+        self.ws_url = base_url.replace("https://", "wss://").replace("http://", "ws://")
+        self.token1 = None
+        self.token2 = None
+        self.user1_id = None
+        self.user2_id = None
+        self.chat_id = None
+        self.ping_interval = float(os.environ.get('WS_PING_INTERVAL', '25'))
+        self.ping_timeout = float(os.environ.get('WS_PING_TIMEOUT', '20'))
+        self.typing_interval = float(os.environ.get('TYPING_INTERVAL', '2'))
+        self.tests_run = 0
+        self.tests_passed = 0
+
+    def check(self, name, condition, detail=""):
+        self.tests_run += 1
+        if condition:
+            self.tests_passed += 1
+            print(f"✅ {name}")
+        else:
+            print(f"❌ {name} {detail}")
+        return condition
+
+    def setup_users_and_chat(self):
+        """Log in two verified test users and open a chat between them"""
+        test_users = [
+            {"email": "realtime.user1@basemapp.com", "password": "TestPassword123!"},
+            {"email": "realtime.user2@basemapp.com", "password": "TestPassword123!"},
+            {"email": "status.test.user1@basemapp.com", "password": "StatusTest123!"},
+            {"email": "status.test.user2@basemapp.com", "password": "StatusTest123!"}
+        ]
+        tokens = []
+        for user_data in test_users:
+            response = requests.post(f"{self.api_url}/auth/login", json=user_data)
+            if response.status_code == 200:
+                tokens.append(response.json()['access_token'])
+                if len(tokens) >= 2:
+                    break
+        if len(tokens) < 2:
+            print("❌ Two verified test users are required")
+            return False
+        self.token1, self.token2 = tokens
+
+        user1_info = requests.get(f"{self.api_url}/auth/me", headers=self.headers(self.token1))
+        user2_info = requests.get(f"{self.api_url}/auth/me", headers=self.headers(self.token2))
+        if user1_info.status_code != 200 or user2_info.status_code != 200:
+            print("❌ Failed to get user IDs")
+            return False
+        self.user1_id = user1_info.json()['id']
+        self.user2_id = user2_info.json()['id']
+        print(f"✅ Got user IDs: {self.user1_id[:8]}... and {self.user2_id[:8]}...")
+
+        chat_response = requests.post(f"{self.api_url}/chats", headers=self.headers(self.token1),
+                                      params={"other_user_id": self.user2_id})
+        if chat_response.status_code != 200:
+            print(f"❌ Chat creation failed: {chat_response.status_code}")
+            return False
+        self.chat_id = chat_response.json()['id']
+        print(f"✅ Chat: {self.chat_id[:8]}...")
+        return True
+
+    @staticmethod
+    def headers(token):
+        return {'Authorization': f'Bearer {token}'}
+
+    def connect(self, user=1, **params):
+        user_id, token = (self.user1_id, self.token1) if user == 1 else (self.user2_id, self.token2)
+        query = "&".join([f"token={token}"] + [f"{key}={value}" for key, value in params.items()])
+        return websockets.connect(f"{self.ws_url}/ws/{user_id}?{query}")
+
+    def send_rest(self, content):
+        response = requests.post(f"{self.api_url}/messages", headers=self.headers(self.token1),
+                                 json={"chat_id": self.chat_id, "content": content, "message_type": "text"})
+        return response.json() if response.status_code == 200 else None
+
+    @staticmethod
+    async def next_event(websocket, predicate, timeout=5.0):
+        """First event matching `predicate` within `timeout` seconds, or None"""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                frame = await asyncio.wait_for(websocket.recv(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return None
+            event = msgpack.unpackb(frame, raw=False) if isinstance(frame, bytes) else json.loads(frame)
+            if predicate(event):
+                return event
+
+    @staticmethod
+    async def events_for(websocket, duration):
+        """Every event received during `duration` seconds"""
+        events = []
+        deadline = time.monotonic() + duration
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return events
+            try:
+                frame = await asyncio.wait_for(websocket.recv(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return events
+            events.append(msgpack.unpackb(frame, raw=False) if isinstance(frame, bytes) else json.loads(frame))
+
+    async def test_resume(self):
+        """Events missed while disconnected are replayed from last_seq; an unknown epoch asks for a resync"""
+        print("\n🔍 Testing resume with last_seq and epoch...")
+        async with self.connect(2) as websocket:
+            session = await self.next_event(websocket, lambda e: e.get("type") == "session")
+        if not self.check("Connecting announces the session", session is not None and "epoch" in session):
+            return False
+
+        missed = self.send_rest("أثناء الانقطاع")
+        if not missed:
+            return False
+        async with self.connect(2, last_seq=session["seq"], epoch=session["epoch"]) as websocket:
+            replayed = await self.next_event(
+                websocket, lambda e: e.get("type") == "new_message" and e["message"]["id"] == missed['id'])
+            resumed = await self.next_event(websocket, lambda e: e.get("type") == "session")
+        ok = self.check("Missed message is replayed", replayed is not None and replayed.get("seq", 0) > session["seq"])
+        ok &= self.check("Session follows the replay", replayed is not None and resumed is not None
+                         and resumed["epoch"] == session["epoch"] and resumed["seq"] >= replayed["seq"])
+
+        async with self.connect(2, last_seq=1, epoch="unknown-epoch") as websocket:
+            resync = await self.next_event(websocket, lambda e: e.get("type") in ("resync_required", "session"))
+        ok &= self.check("Unknown epoch requires a resync", resync is not None and resync["type"] == "resync_required",
+                         f"(got {resync})")
+        return ok
+
+    async def test_ack_frames(self):
+        """Valid acks update receipts for the sender; malformed or foreign acks get an error frame"""
+        print("\n🔍 Testing ack frames...")
+        async with self.connect(1) as sender, self.connect(2) as reader:
+            await self.next_event(reader, lambda e: e.get("type") == "session")
+            message = self.send_rest("أقرأ هذه")
+            if not message:
+                return False
+            received = await self.next_event(
+                reader, lambda e: e.get("type") == "new_message" and e["message"]["id"] == message['id'])
+            ok = self.check("Reader receives the message", received is not None)
+
+            await reader.send(json.dumps({"type": "ack", "status": "read", "chat_id": self.chat_id,
+                                          "message_ids": [message['id']]}))
+            receipt = await self.next_event(
+                sender, lambda e: e.get("type") == "receipts" and e["status"] == "read"
+                and message['id'] in e["chats"].get(self.chat_id, []))
+            ok &= self.check("Read ack reaches the sender as a receipt", receipt is not None)
+
+            await reader.send(json.dumps({"type": "ack", "status": "seen", "chat_id": self.chat_id,
+                                          "message_ids": [message['id']]}))
+            invalid = await self.next_event(reader, lambda e: e.get("type") == "error")
+            ok &= self.check("Malformed ack is rejected", invalid is not None and invalid["detail"] == "Invalid ack",
+                             f"(got {invalid})")
+
+            await reader.send(json.dumps({"type": "ack", "status": "read", "chat_id": str(uuid.uuid4()),
+                                          "ranges": [[1, 5]]}))
+            foreign = await self.next_event(reader, lambda e: e.get("type") == "error")
+            ok &= self.check("Ack for a chat the user is not in is rejected",
+                             foreign is not None and foreign["detail"] == "Chat not found", f"(got {foreign})")
+        return ok
+
+    async def test_ping_and_reap(self):
+        """Client pings get a pong; a silent client is pinged, then reaped"""
+        print("\n🔍 Testing ping, pong and reaping...")
+        async with self.connect(2) as websocket:
+            await websocket.send(json.dumps({"type": "ping"}))
+            pong = await self.next_event(websocket, lambda e: e.get("type") == "pong")
+            ok = self.check("Client ping is answered with pong", pong is not None)
+
+            print(f"   Staying silent for up to {self.ping_interval + self.ping_timeout + 10:.0f}s...")
+            ping = await self.next_event(websocket, lambda e: e.get("type") == "ping",
+                                         timeout=self.ping_interval + 5)
+            ok &= self.check("Server pings an idle client", ping is not None)
+            try:
+                await asyncio.wait_for(websocket.wait_closed(), timeout=self.ping_timeout + 10)
+                reaped = True
+            except asyncio.TimeoutError:
+                reaped = False
+            ok &= self.check("Silent client is reaped", reaped)
+        return ok
+
+    async def test_typing_throttle(self):
+        """A burst of typing frames fans out one start; the stop waits for the typing interval"""
+        print("\n🔍 Testing typing throttle...")
+        async with self.connect(1) as typist, self.connect(2) as watcher:
+            await self.next_event(watcher, lambda e: e.get("type") == "session")
+            for _ in range(4):
+                await typist.send(json.dumps({"type": "typing", "chat_id": self.chat_id, "is_typing": True}))
+            is_typist = lambda e: e.get("type") == "typing" and e.get("user_id") == self.user1_id
+            start = await self.next_event(watcher, is_typist)
+            started_at = time.monotonic()
+            await typist.send(json.dumps({"type": "typing", "chat_id": self.chat_id, "is_typing": False}))
+            stop = await self.next_event(watcher, is_typist, timeout=self.typing_interval + 2)
+            stop_delay = time.monotonic() - started_at
+            ok = self.check("A burst of starts fans out one start", start is not None and start["is_typing"] is True)
+            ok &= self.check("The stop follows", stop is not None and stop["is_typing"] is False, f"(got {stop})")
+            # Arrival times include network latency, so allow a little slack below the interval
+            ok &= self.check("Stop is held back by the typing interval", stop_delay >= self.typing_interval * 0.8,
+                             f"({stop_delay:.2f}s)")
+            extra = await self.events_for(watcher, 1)
+            ok &= self.check("Nothing else is fanned out", not [e for e in extra if is_typist(e)])
+
+            await typist.send(json.dumps({"type": "typing", "chat_id": str(uuid.uuid4()), "is_typing": True}))
+            error = await self.next_event(typist, lambda e: e.get("type") == "error")
+            ok &= self.check("Typing in a foreign chat is rejected", error is not None and error["detail"] == "Chat not found")
+        return ok
+
+    async def test_rate_limit(self):
+        """send_message frames beyond the burst are rejected with retry_after and nothing is stored for them"""
+        print("\n🔍 Testing inbound rate limit...")
+        burst = int(float(os.environ.get('WS_RATE_MESSAGE', '5/20').partition("/")[2] or 20))
+        async with self.connect(1) as websocket:
+            await self.next_event(websocket, lambda e: e.get("type") == "session")
+            client_msg_ids = [str(uuid.uuid4()) for _ in range(burst + 5)]
+            for client_msg_id in client_msg_ids:
+                await websocket.send(json.dumps({"type": "send_message", "chat_id": self.chat_id,
+                                                 "content": "دفعة", "client_msg_id": client_msg_id}))
+            events = await self.events_for(websocket, 5)
+        rejected = [e for e in events if e.get("type") == "error" and e.get("detail") == "Rate limit exceeded"]
+        sent = [e for e in events if e.get("type") == "message_sent"]
+        # Tokens refill while the frames are in flight, so a few more than the burst may pass
+        ok = self.check("Frames beyond the burst are rejected", bool(rejected), f"({len(sent)} sent, none rejected)")
+        ok &= self.check("Rejections carry retry_after and the client_msg_id",
+                         all(e["retry_after"] > 0 and e["client_msg_id"] in client_msg_ids for e in rejected))
+        rejected_ids = {e["client_msg_id"] for e in rejected}
+        ok &= self.check("Accepted frames are acknowledged",
+                         len(sent) == len(client_msg_ids) - len(rejected)
+                         and not rejected_ids & {e["message"]["client_msg_id"] for e in sent})
+        return ok
+
+    async def test_msgpack_negotiation(self):
+        """Offering the msgpack subprotocol switches both directions to binary MessagePack frames"""
+        print("\n🔍 Testing msgpack negotiation...")
+        if msgpack is None:
+            print("⚠️  msgpack is not installed here; skipping")
+            return True
+        user_id, token = self.user2_id, self.token2
+        url = f"{self.ws_url}/ws/{user_id}?token={token}"
+        async with websockets.connect(url, subprotocols=["msgpack", "json"]) as websocket:
+            ok = self.check("Server selects msgpack", websocket.subprotocol == "msgpack",
+                            f"(got {websocket.subprotocol})")
+            frame = await asyncio.wait_for(websocket.recv(), timeout=5)
+            ok &= self.check("Frames are binary", isinstance(frame, bytes))
+            await websocket.send(msgpack.packb({"type": "ping"}))
+            pong = await self.next_event(websocket, lambda e: e.get("type") == "pong")
+            ok &= self.check("A msgpack ping is answered in msgpack", pong is not None)
+
+        async with websockets.connect(url, subprotocols=["json"]) as websocket:
+            ok &= self.check("Offering only json keeps JSON", websocket.subprotocol == "json")
+            frame = await asyncio.wait_for(websocket.recv(), timeout=5)
+            ok &= self.check("Frames are text", isinstance(frame, str))
+        return ok
+
+    async def run_websocket_scenarios(self):
+        print("🚀 Starting WebSocket Scenario Tests")
+        print("=" * 40)
+        if not self.setup_users_and_chat():
+            print("❌ Setup failed, cannot run WebSocket scenarios")
+            return False
+
+        results = []
+        for name, scenario in [
+            ("Resume and resync", self.test_resume),
+            ("Ack frames", self.test_ack_frames),
+            ("Typing throttle", self.test_typing_throttle),
+            ("Rate limit", self.test_rate_limit),
+            ("msgpack negotiation", self.test_msgpack_negotiation),
+            ("Ping and reap", self.test_ping_and_reap)
+        ]:
+            try:
+                results.append((name, await scenario()))
+            except Exception as e:
+                print(f"❌ {name} failed: {str(e)}")
+                results.append((name, False))
+
+        print("\n" + "=" * 40)
+        for name, success in results:
+            print(f"   {name}: {'✅' if success else '❌'}")
+        print(f"📈 Checks passed: {self.tests_passed}/{self.tests_run}")
+        return all(success for _, success in results)
+
+async def main():
+    tester = WebSocketScenarioTester()
+    success = await tester.run_websocket_scenarios()
+    return 0 if success else 1
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
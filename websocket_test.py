@@ -90,8 +90,8 @@ class WebSocketTester:
         
         try:
             # Connect user 1
-            ws1_url = f"{self.ws_url}/ws/{self.user1_id}"
-            print(f"Connecting to: {ws1_url}")
+            ws1_url = f"{self.ws_url}/ws/{self.user1_id}?token={self.token1}"
+            print(f"Connecting to: {self.ws_url}/ws/{self.user1_id}")
             
             async with websockets.connect(ws1_url) as websocket1:
                 print("✅ User 1 WebSocket connected")